@@ -2,10 +2,13 @@
 import json
 import os
 import html
+import importlib
 from urllib.parse import urlparse
 
 import requests
 import io
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import plugins
 from bridge.context import ContextType
 from bridge.reply import Reply, ReplyType
@@ -14,6 +17,51 @@ from plugins import *
 import re
 import time
 
+
+def _find_summary_package():
+    """
+    查找 Summary 插件的包名：JinaSum 可能位于 Summary 插件目录内，也可能单独安装在 plugins/ 下，
+    Summary 插件目录名也不固定，因此按 llm_client.py 所在的目录确定
+    """
+    jina_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = os.path.dirname(jina_dir)
+    if os.path.isfile(os.path.join(parent_dir, "llm_client.py")):
+        return f"plugins.{os.path.basename(parent_dir)}"
+    for name in sorted(os.listdir(parent_dir)):
+        plugin_dir = os.path.join(parent_dir, name)
+        if plugin_dir != jina_dir and os.path.isfile(os.path.join(plugin_dir, "llm_client.py")) \
+                and os.path.isfile(os.path.join(plugin_dir, "scheduler.py")):
+            return f"plugins.{name}"
+    return None
+
+
+try:
+    # 与 Summary 插件共用的 LLM HTTP 客户端（长连接、超时、429/5xx 退避重试）和配额调度器
+    _summary_package = _find_summary_package()
+    if _summary_package is None:
+        raise ImportError("未找到 Summary 插件目录")
+    LLMHttpClient = importlib.import_module(f"{_summary_package}.llm_client").LLMHttpClient
+    _scheduler = importlib.import_module(f"{_summary_package}.scheduler")
+    PRIORITY_LINK = _scheduler.PRIORITY_LINK
+    RateLimitExceeded = _scheduler.RateLimitExceeded
+    get_shared_scheduler = _scheduler.get_shared_scheduler
+except ImportError as e:
+    logger.warning(f"[JinaSum] 无法加载 Summary 插件的 LLM 客户端和调度器，LLM 请求不做限流: {e}")
+    LLMHttpClient = None
+    get_shared_scheduler = None
+
+    class RateLimitExceeded(Exception):
+        pass
+
+# 抓取网页内容（以及未加载 Summary 插件的 LLM 客户端时的 LLM 请求）使用的共享会话：复用连接，
+# 连接失败和 429/5xx 时退避重试最多 2 次；读取超时不重试，避免一次请求等待数倍的超时时间
+_session = requests.Session()
+_session.mount("http://", HTTPAdapter(max_retries=Retry(
+    total=2, read=0, backoff_factor=1, status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=None, raise_on_status=False,
+)))
+_session.mount("https://", _session.get_adapter("http://"))
+
 @plugins.register(
     name="JinaSum",
     desire_priority=10,
@@ -54,13 +102,16 @@ class JinaSum(Plugin):
             self.black_url_list = self.config.get("black_url_list", self.black_url_list)
             self.generate_image = self.config.get("generate_image", True)
             self.black_group_list = self.config.get("black_group_list", [])
+            self.llm_timeout = self.config.get("llm_timeout", 60)
+            self.llm_client = LLMHttpClient(read_timeout=self.llm_timeout) if LLMHttpClient else None
+            self.llm_scheduler = get_shared_scheduler() if get_shared_scheduler else None
             logger.info(f"[JinaSum] inited, config={self.config}")
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
         except Exception as e:
             logger.error(f"[JinaSum] 初始化异常：{e}")
             raise "[JinaSum] init failed, ignore "
 
-    def on_handle_context(self, e_context: EventContext, retry_count: int = 0):
+    def on_handle_context(self, e_context: EventContext):
         try:
             context = e_context["context"]
             content = context.content
@@ -110,7 +161,14 @@ class JinaSum(Plugin):
             logger.debug(f"[JinaSum] openai_chat_url: {openai_chat_url}, openai_headers: {openai_headers}, openai_payload: {openai_payload}")
             
             headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0.0.0 Safari/537.36"}
-            response = requests.post(openai_chat_url, headers={**openai_headers, **headers}, json=openai_payload, timeout=60)
+            if self.llm_scheduler:
+                # 链接总结优先级低于 $总结、高于后台识图；粗略按 4 个字符 1 个 token 估算
+                prompt_length = sum(len(m["content"]) for m in openai_payload["messages"])
+                self.llm_scheduler.acquire(self.open_ai_api_key, prompt_length // 4 + 1000, PRIORITY_LINK)
+            if self.llm_client:
+                response = self.llm_client.post(openai_chat_url, headers={**openai_headers, **headers}, json=openai_payload)
+            else:
+                response = _session.post(openai_chat_url, headers={**openai_headers, **headers}, json=openai_payload, timeout=self.llm_timeout)
             response.raise_for_status()
             result = response.json()['choices'][0]['message']['content']
             logger.info(f"[JinaSum] LLM原始返回内容：\n{result}")
@@ -155,12 +213,14 @@ class JinaSum(Plugin):
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
 
-        except Exception as e:
-            if retry_count < 3:
-                logger.warning(f"[JinaSum] {str(e)}, retry {retry_count + 1}")
-                self.on_handle_context(e_context, retry_count + 1)
-                return
+        except RateLimitExceeded as e:
+            logger.warning(f"[JinaSum] {str(e)}")
+            reply = Reply(ReplyType.ERROR, "当前请求较多，请稍后再试")
+            e_context["reply"] = reply
+            e_context.action = EventAction.BREAK_PASS
 
+        except Exception as e:
+            # LLM 请求的重试由 LLMHttpClient 完成，这里不再整体重试
             logger.exception(f"[JinaSum] {str(e)}")
             reply = Reply(ReplyType.ERROR, "我暂时无法总结链接，请稍后再试")
             e_context["reply"] = reply
@@ -202,7 +262,7 @@ class JinaSum(Plugin):
             
             logger.info(f"[JinaSum] 开始抓取URL: {target_url}, 是否是微信公众号: {is_wechat_mp}")
             
-            response = requests.post(
+            response = _session.post(
                 self.firecrawl_api_base, 
                 headers=headers, 
                 json=payload,
@@ -0,0 +1,167 @@
+# encoding:utf-8
+"""
+消息处理的微基准测试
+
+使用 corpus.json 中脱敏的各类消息（普通文本、触发消息、引用、音乐分享、视频号、长文章、图片等），
+分别测量 _process_message_content 和完整的 on_receive_message 路径，按消息类型输出吞吐量（条/秒）
+和单条耗时的 p50/p99，用于比较消息解析相关改动前后的性能。
+
+在宿主项目根目录运行（插件需位于 plugins/ 下）：
+
+    python plugins/summary/benchmarks/bench_messages.py -n 2000
+    python plugins/summary/benchmarks/bench_messages.py --stage content --warm-cache
+    python plugins/summary/benchmarks/bench_messages.py --output plugins/summary/bench_output.txt
+
+on_receive_message 阶段使用临时目录中的 SQLite 数据库，不会写入插件目录下的 chat.db；
+入库由写线程在后台完成，计时只包含放入写后队列的开销。
+"""
+
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, os.path.dirname(os.path.dirname(PLUGIN_DIR)))
+
+from bridge.context import Context, ContextType  # noqa: E402
+from plugins import Event, EventContext  # noqa: E402
+
+PLUGIN_PACKAGE = f"plugins.{os.path.basename(PLUGIN_DIR)}"
+summary_main = importlib.import_module(f"{PLUGIN_PACKAGE}.main")
+message_parser = importlib.import_module(f"{PLUGIN_PACKAGE}.message_parser")
+storage = importlib.import_module(f"{PLUGIN_PACKAGE}.storage")
+
+# 基准测试使用的插件配置：只启用 SQLite，不配置多模态模型，图片消息不会触发识图
+BENCH_CONFIG = {
+    "open_ai_api_key": "sk-bench",
+    "group_chat_prefix": ["bot"],
+    "group_chat_keyword": ["机器人"],
+    "single_chat_prefix": [""],
+    "image_caption_cache": False,
+}
+
+
+class _StubMessage:
+    """on_receive_message 用到的 ChatMessage 字段"""
+
+    def __init__(self, msg_id, sample):
+        self.msg_id = msg_id
+        self.create_time = int(time.time())
+        self.from_user_id = "bench_room" if sample["isgroup"] else "bench_user"
+        self.from_user_nickname = "用户甲"
+        self.other_user_nickname = "基准测试群" if sample["isgroup"] else None
+        self.actual_user_id = "bench_user"
+        self.actual_user_nickname = "用户甲"
+        self.is_at = sample.get("is_at", False)
+
+    def prepare(self):
+        pass
+
+
+def load_corpus(path):
+    with open(path, encoding="utf-8") as f:
+        samples = json.load(f)
+    for sample in samples:
+        sample["type"] = ContextType[sample["context_type"]]
+    return samples
+
+
+def create_plugin(db_dir):
+    """创建使用临时数据库和基准配置的插件实例"""
+    summary_main.Summary._load_config = lambda self: dict(BENCH_CONFIG)
+    summary_main.SQLiteStore = lambda db_path, **kwargs: storage.SQLiteStore(os.path.join(db_dir, "chat.db"), **kwargs)
+    return summary_main.Summary()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+
+def run_stage(samples, iterations, call, prepare=None, warm_cache=False):
+    """
+    对每条样本执行 iterations 次 call，返回 {消息类型: [单次耗时 ns]}
+
+    :param prepare: 每次调用前生成参数的函数，不计入耗时；默认直接使用样本
+    :param warm_cache: 是否保留消息分类缓存；默认每次调用前清空，测量完整的解析开销
+    """
+    timings = {}
+    for sample in samples:
+        call(prepare(sample) if prepare else sample)  # 预热
+    for _ in range(iterations):
+        for sample in samples:
+            arg = prepare(sample) if prepare else sample
+            if not warm_cache:
+                message_parser.classify_message.cache_clear()
+            start = time.perf_counter_ns()
+            call(arg)
+            timings.setdefault(sample["kind"], []).append(time.perf_counter_ns() - start)
+    return timings
+
+
+def report(stage, timings):
+    rows = list(timings.items())
+    rows.append(("all", [value for values in timings.values() for value in values]))
+    lines = [f"[{stage}]", f"{'type':<10}{'count':>10}{'msgs/sec':>14}{'p50 us':>12}{'p99 us':>12}"]
+    for kind, values in rows:
+        values = sorted(values)
+        total_s = sum(values) / 1e9
+        lines.append(
+            f"{kind:<10}{len(values):>10}{len(values) / total_s if total_s else 0:>14.0f}"
+            f"{percentile(values, 50) / 1000:>12.1f}{percentile(values, 99) / 1000:>12.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summary 插件消息处理微基准测试")
+    parser.add_argument("-n", "--iterations", type=int, default=1000, help="每条样本的执行次数")
+    parser.add_argument("--stage", choices=("content", "receive", "all"), default="all")
+    parser.add_argument("--corpus", default=os.path.join(BENCH_DIR, "corpus.json"))
+    parser.add_argument("--warm-cache", action="store_true", help="保留消息分类缓存（默认每次调用前清空）")
+    parser.add_argument("--output", help="同时把结果写入该文件")
+    args = parser.parse_args()
+
+    samples = load_corpus(args.corpus)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="summary-bench-") as db_dir:
+        plugin = create_plugin(db_dir)
+        try:
+            if args.stage in ("content", "all"):
+                timings = run_stage(
+                    samples, args.iterations,
+                    lambda sample: plugin._process_message_content(sample["content"], sample["type"]),
+                    warm_cache=args.warm_cache,
+                )
+                results.append(report("_process_message_content", timings))
+
+            if args.stage in ("receive", "all"):
+                msg_ids = iter(range(1, 1 << 62))
+
+                def build_event(sample):
+                    cmsg = _StubMessage(next(msg_ids), sample)
+                    context = Context(sample["type"], sample["content"], {"isgroup": sample["isgroup"], "msg": cmsg})
+                    return EventContext(Event.ON_RECEIVE_MESSAGE, {"context": context, "channel": None})
+
+                timings = run_stage(
+                    samples, args.iterations, plugin.on_receive_message, prepare=build_event, warm_cache=args.warm_cache,
+                )
+                results.append(report("on_receive_message", timings))
+        finally:
+            plugin._shutdown()
+
+    output = "\n\n".join(results)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
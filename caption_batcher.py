@@ -0,0 +1,136 @@
+# encoding:utf-8
+
+import asyncio
+import re
+
+from common.log import logger
+
+# 一次请求描述多张图片时附加在识图提示词外的说明，{prompt} 为单张图片的提示词
+BATCH_CAPTION_PROMPT = (
+    "上面按顺序给出了 {count} 张图片，每张图片前标有序号。请对每张图片分别按以下要求描述：\n"
+    "{prompt}\n\n"
+    "按图片顺序输出，每张图片的描述以【序号】开头，单独成段，例如：\n"
+    "【1】第一张图片的描述\n"
+    "【2】第二张图片的描述"
+)
+
+_CAPTION_MARKER_RE = re.compile(r"^[ \t*#>]*【(\d+)】[ \t*:：]*", re.M)
+
+
+def split_batch_captions(text, count):
+    """
+    把多图请求的回复按【序号】拆分为各张图片的描述
+
+    :return: 按图片顺序排列的描述列表；序号缺失或某张图片没有描述时返回 None
+    """
+    if not text:
+        return None
+    markers = list(_CAPTION_MARKER_RE.finditer(text))
+    captions = {}
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(text)
+        index = int(marker.group(1))
+        caption = text[marker.end():end].strip()
+        if 1 <= index <= count and caption and index not in captions:
+            captions[index] = caption
+    if len(captions) != count:
+        return None
+    return [captions[i] for i in range(1, count + 1)]
+
+
+class _Batch:
+    __slots__ = ("items", "timer")
+
+    def __init__(self):
+        self.items = []  # [(encoded_image, future)]
+        self.timer = None
+
+
+class CaptionBatcher:
+    """
+    识图请求的微批处理
+
+    同一会话在 window 秒内到达的图片（如一次发送的多张照片）合并为一个包含多个 image_url 的请求，
+    攒满 max_size 张时立即发送；回复按序号拆回各张图片，无法拆分时退回逐张识别。
+    所有方法都必须在 LLM 引擎的事件循环中调用。
+    """
+
+    def __init__(self, describe, describe_batch, window=1.5, max_size=4):
+        """
+        :param describe: 协程函数 describe(encoded_image) -> 描述或 None
+        :param describe_batch: 协程函数 describe_batch(encoded_images) -> 按顺序排列的描述列表，失败时返回 None
+        """
+        self.describe = describe
+        self.describe_batch = describe_batch
+        self.window = window
+        self.max_size = max(1, int(max_size))
+        self._pending = {}  # 会话 -> _Batch
+        self._tasks = set()  # 执行中的请求，保留引用以免被垃圾回收
+        self.images = 0
+        self.requests = 0
+        self.batched_requests = 0
+        self.fallbacks = 0
+
+    async def caption(self, key, encoded_image):
+        """描述一张图片，key 相同的图片可能被合并到同一个请求中"""
+        self.images += 1
+        if self.max_size == 1:
+            self.requests += 1
+            return await self.describe(encoded_image)
+
+        loop = asyncio.get_running_loop()
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _Batch()
+            batch.timer = loop.call_later(self.window, self._flush, key)
+        future = loop.create_future()
+        batch.items.append((encoded_image, future))
+        if len(batch.items) >= self.max_size:
+            self._flush(key)
+        return await future
+
+    def _flush(self, key):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        batch.timer.cancel()
+        task = asyncio.ensure_future(self._run(batch.items))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, items):
+        images = [image for image, _ in items]
+        try:
+            if len(images) == 1:
+                self.requests += 1
+                results = [await self.describe(images[0])]
+            else:
+                self.requests += 1
+                self.batched_requests += 1
+                results = await self.describe_batch(images)
+                if results is None:
+                    self.fallbacks += 1
+                    self.requests += len(images)
+                    logger.warning(f"[Summary] {len(images)} 张图片的合并识图结果无法拆分，改为逐张识别")
+                    results = await asyncio.gather(*(self.describe(image) for image in images), return_exceptions=True)
+                else:
+                    logger.debug(f"[Summary] 合并识图：{len(images)} 张图片使用 1 个请求")
+        except Exception as e:
+            results = [e] * len(items)
+
+        for (_, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "images": self.images,
+            "requests": self.requests,
+            "batched_requests": self.batched_requests,
+            "fallbacks": self.fallbacks,
+            "pending_sessions": len(self._pending),
+        }
@@ -0,0 +1,188 @@
+# encoding:utf-8
+
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from common.log import logger
+
+_SIGN_BIT = 1 << 63
+
+
+def _dhash_bits(gray, size):
+    """比较缩小为 (size+1)xsize 的灰度图每行相邻像素的明暗，得到 size*size 位的差值哈希（dHash）"""
+    pixels = np.asarray(gray.resize((size + 1, size), Image.LANCZOS), dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1])
+
+
+def image_hashes(img):
+    """
+    计算图片的 64 位差值哈希（9x8）和用于确认的 256 位差值哈希（17x16）
+
+    dHash 对缩放、重新压缩和轻微调色不敏感，同一张图被转发、压缩后的各个副本 64 位哈希相同或只差几位，
+    256 位哈希通常只差 10 位以内；布局相同的截图、图表（如不同价格的行情截图）64 位哈希可能只差几位，
+    256 位哈希则相差 20 位左右以上。
+
+    :return: (64 位哈希, 256 位哈希的 4 个 uint64 组成的数组)
+    """
+    gray = img.convert("L")
+    phash = int.from_bytes(_dhash_bits(gray, 8).tobytes(), "big")
+    detail = _dhash_bits(gray, 16).view(">u8").astype(np.uint64)
+    return phash, detail
+
+
+def _to_signed(value):
+    """数据库的 BIGINT/INTEGER 是有符号 64 位整数"""
+    return value - (1 << 64) if value & _SIGN_BIT else value
+
+
+def _to_unsigned(value):
+    return value & ((1 << 64) - 1)
+
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:
+    def _popcount(values):
+        return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class CaptionCache:
+    """
+    按感知哈希缓存图片描述
+
+    同一张截图或表情包常被转发到多个群，命中缓存的图片直接复用已有描述，不再调用多模态 LLM。
+    描述持久化在 image_captions 表中，启动时载入最近的 max_size 条；查找在内存中对全部 64 位哈希
+    做向量化的汉明距离计算，距离不超过 max_distance（默认 0，即哈希相同）的为候选，
+    候选还要求 256 位哈希的距离不超过 max_detail_distance 才视为同一张图，避免把布局相同的不同截图混为一张。
+    没有 256 位哈希的旧描述只在 64 位哈希相同时使用。
+    prompt_key 标识生成描述时使用的模型和提示词，变化后旧的描述不再使用。
+    """
+
+    def __init__(self, db, use_postgres, prompt_key, max_size=50000, max_distance=0, max_detail_distance=12):
+        self.db = db
+        self.use_postgres = use_postgres
+        self.prompt_key = prompt_key
+        self.max_size = max(1, int(max_size))
+        self.max_distance = max_distance
+        self.max_detail_distance = max_detail_distance
+        self._hashes = np.zeros(self.max_size, dtype=np.uint64)
+        self._details = np.zeros((self.max_size, 4), dtype=np.uint64)
+        self._has_detail = np.zeros(self.max_size, dtype=bool)
+        self._captions = [None] * self.max_size
+        self._size = 0
+        self._next = 0  # 写满后从最旧的位置开始覆盖
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+
+    def init_schema(self, cursor):
+        """创建 image_captions 表并载入最近的描述"""
+        cursor.execute('''CREATE TABLE IF NOT EXISTS image_captions
+                        (phash BIGINT NOT NULL,
+                        prompt_key TEXT NOT NULL,
+                        caption TEXT,
+                        created_at BIGINT,
+                        detail_hash TEXT,
+                        PRIMARY KEY (phash, prompt_key))''')
+        # 256 位哈希（十六进制），旧版本的表没有该列
+        if self.use_postgres:
+            cursor.execute("ALTER TABLE image_captions ADD COLUMN IF NOT EXISTS detail_hash TEXT")
+            cursor.execute(
+                "SELECT phash, caption, detail_hash FROM image_captions WHERE prompt_key=%s ORDER BY created_at DESC LIMIT %s",
+                (self.prompt_key, self.max_size)
+            )
+        else:
+            cursor.execute("PRAGMA table_info(image_captions);")
+            if 'detail_hash' not in [column[1] for column in cursor.fetchall()]:
+                cursor.execute("ALTER TABLE image_captions ADD COLUMN detail_hash TEXT;")
+            cursor.execute(
+                "SELECT phash, caption, detail_hash FROM image_captions WHERE prompt_key=? ORDER BY created_at DESC LIMIT ?",
+                (self.prompt_key, self.max_size)
+            )
+        rows = cursor.fetchall()
+        # 按时间从旧到新放入，最新的描述最后被覆盖
+        for phash, caption, detail_hash in reversed(rows):
+            detail = np.frombuffer(bytes.fromhex(detail_hash), dtype=">u8").astype(np.uint64) if detail_hash else None
+            self._add((_to_unsigned(phash), detail), caption)
+        if rows:
+            logger.info(f"[Summary] 已载入 {len(rows)} 条图片描述缓存")
+
+    def _add(self, image_hash, caption):
+        phash, detail = image_hash
+        with self._lock:
+            self._hashes[self._next] = phash
+            self._has_detail[self._next] = detail is not None
+            if detail is not None:
+                self._details[self._next] = detail
+            self._captions[self._next] = caption
+            self._next = (self._next + 1) % self.max_size
+            self._size = min(self._size + 1, self.max_size)
+
+    def match(self, img):
+        """
+        计算图片的哈希并查找同一张图片的描述
+
+        :return: (哈希, 描述)，哈希用于 store，未命中时描述为 None
+        """
+        image_hash = image_hashes(img)
+        phash, detail = image_hash
+        with self._lock:
+            if self._size:
+                distances = _popcount(np.bitwise_xor(self._hashes[:self._size], np.uint64(phash)))
+                candidates = np.flatnonzero(distances <= self.max_distance)
+                if candidates.size:
+                    # 用 256 位哈希确认候选；没有 256 位哈希的旧描述只接受完全相同的 64 位哈希
+                    detail_distances = _popcount(np.bitwise_xor(self._details[candidates], detail).ravel()).reshape(-1, 4).sum(axis=1)
+                    confirmed = np.where(
+                        self._has_detail[candidates],
+                        detail_distances <= self.max_detail_distance,
+                        distances[candidates] == 0,
+                    )
+                    if confirmed.any():
+                        ranked = np.where(confirmed, detail_distances, np.iinfo(np.int64).max)
+                        index = int(candidates[int(np.argmin(ranked))])
+                        self.hits += 1
+                        if distances[index]:
+                            self.near_hits += 1
+                        return image_hash, self._captions[index]
+            self.misses += 1
+        return image_hash, None
+
+    def store(self, image_hash, caption):
+        """保存一张图片的描述，image_hash 为 match 返回的哈希；写入数据库失败时只保留在内存中"""
+        self._add(image_hash, caption)
+        phash, detail = image_hash
+        row = (_to_signed(phash), self.prompt_key, caption, int(time.time()), detail.astype(">u8").tobytes().hex())
+        try:
+            with self.db.write() as conn:
+                cursor = conn.cursor()
+                if self.use_postgres:
+                    cursor.execute(
+                        "INSERT INTO image_captions (phash, prompt_key, caption, created_at, detail_hash) VALUES (%s, %s, %s, %s, %s) "
+                        "ON CONFLICT (phash, prompt_key) DO UPDATE SET caption = EXCLUDED.caption, created_at = EXCLUDED.created_at, "
+                        "detail_hash = EXCLUDED.detail_hash",
+                        row
+                    )
+                else:
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO image_captions (phash, prompt_key, caption, created_at, detail_hash) VALUES (?, ?, ?, ?, ?)",
+                        row
+                    )
+        except Exception as e:
+            logger.error(f"[Summary] 写入图片描述缓存失败: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self._size,
+                "max_size": self.max_size,
+                "max_distance": self.max_distance,
+                "max_detail_distance": self.max_detail_distance,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,294 @@
+# encoding:utf-8
+
+import asyncio
+import threading
+import time
+
+from common.log import logger
+
+# 任务处理结果
+JOB_DONE = "done"  # 完成，删除任务
+JOB_RETRY = "retry"  # 暂时失败，退避后重试
+JOB_FAILED = "failed"  # 无法完成（如图片已不存在），不再重试
+
+# 没有到期任务时的最长休眠（秒），用于及时清理过期任务
+_IDLE_INTERVAL = 5.0
+
+
+class CaptionJob:
+    """一个待识图的图片消息"""
+
+    __slots__ = ("sessionid", "msgid", "sessionname", "userid", "username", "image_path", "create_time", "attempts", "enqueued_at")
+
+    def __init__(self, sessionid, msgid, sessionname, userid, username, image_path, create_time, attempts=0, enqueued_at=None):
+        self.sessionid = sessionid
+        self.msgid = msgid
+        self.sessionname = sessionname
+        self.userid = userid
+        self.username = username
+        self.image_path = image_path
+        self.create_time = create_time
+        self.attempts = attempts
+        self.enqueued_at = enqueued_at if enqueued_at is not None else int(time.time())
+
+
+class CaptionJobQueue:
+    """
+    持久化的识图任务队列
+
+    任务保存在 caption_jobs 表中，重启后未完成的任务继续执行（执行中的任务重置为等待）。
+    最多 concurrency 个任务在 LLM 引擎的事件循环中并发执行；排队任务达到 max_pending 时
+    新任务被拒绝，排队超过 max_age 秒的任务直接跳过；失败的任务按指数退避重试，
+    最多执行 max_attempts 次。
+    """
+
+    _COLUMNS = "sessionid, msgid, sessionname, userid, username, image_path, create_time, attempts, enqueued_at"
+
+    def __init__(self, db, use_postgres, handler, concurrency=4, max_pending=1000, max_age=3600,
+                 max_attempts=3, retry_base=5, retry_max=300):
+        """
+        :param handler: 协程函数 handler(job)，返回 JOB_DONE / JOB_RETRY / JOB_FAILED 或 (结果, 错误信息)，抛出异常视为 JOB_RETRY
+        """
+        self.db = db
+        self.use_postgres = use_postgres
+        self.handler = handler
+        self.concurrency = max(1, int(concurrency))
+        self.max_pending = max(1, int(max_pending))
+        self.max_age = max_age
+        self.max_attempts = max(1, int(max_attempts))
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.engine = None
+        self._wake = None
+        self._running = set()
+        self._closed = False
+        self._depth = 0  # 表中尚未结束的任务数（含执行中）
+        self._lock = threading.Lock()
+        self.enqueued = 0
+        self.completed = 0
+        self.retried = 0
+        self.failed = 0
+        self.expired = 0
+        self.rejected = 0
+
+    def init_schema(self, cursor):
+        """创建 caption_jobs 表，并把上次退出时执行中的任务重置为等待"""
+        cursor.execute('''CREATE TABLE IF NOT EXISTS caption_jobs
+                        (sessionid TEXT NOT NULL,
+                        msgid BIGINT NOT NULL,
+                        sessionname TEXT,
+                        userid TEXT,
+                        username TEXT,
+                        image_path TEXT,
+                        create_time BIGINT,
+                        attempts INTEGER DEFAULT 0,
+                        state TEXT DEFAULT 'pending',
+                        next_attempt_at BIGINT,
+                        enqueued_at BIGINT,
+                        last_error TEXT,
+                        PRIMARY KEY (sessionid, msgid))''')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_caption_jobs_due ON caption_jobs (state, next_attempt_at)")
+        cursor.execute("UPDATE caption_jobs SET state = 'pending' WHERE state = 'running'")
+        cursor.execute("SELECT COUNT(*) FROM caption_jobs")
+        self._depth = cursor.fetchone()[0]
+        if self._depth:
+            logger.info(f"[Summary] 恢复 {self._depth} 个未完成的识图任务")
+
+    def start(self, engine):
+        """在 LLM 引擎中启动调度协程"""
+        self.engine = engine
+        engine.submit(self._dispatch())
+
+    def close(self):
+        """停止调度；执行中的任务随引擎关闭而取消，下次启动时重新执行"""
+        self._closed = True
+        self._notify()
+
+    def _notify(self):
+        if self.engine is not None and self._wake is not None:
+            self.engine.loop.call_soon_threadsafe(self._wake.set)
+
+    def enqueue(self, job):
+        """
+        加入一个识图任务
+
+        :return: 排队任务已达上限时返回 False，任务被丢弃
+        """
+        with self._lock:
+            if self._depth >= self.max_pending:
+                self.rejected += 1
+                return False
+            self._depth += 1
+            self.enqueued += 1
+        self.engine.submit(self._insert(job))
+        return True
+
+    async def _insert(self, job):
+        try:
+            await self.engine.run_blocking(self._insert_job, job)
+        except Exception as e:
+            with self._lock:
+                self._depth -= 1
+            logger.error(f"[Summary] 保存识图任务失败: {e}")
+            return
+        if self._wake is not None:
+            self._wake.set()
+
+    def _insert_job(self, job):
+        row = (job.sessionid, job.msgid, job.sessionname, job.userid, job.username, job.image_path,
+               job.create_time, job.attempts, job.enqueued_at, job.enqueued_at)
+        with self.db.write() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                cursor.execute(
+                    f"INSERT INTO caption_jobs ({self._COLUMNS}, state, next_attempt_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'pending', %s) "
+                    "ON CONFLICT (sessionid, msgid) DO NOTHING",
+                    row
+                )
+            else:
+                cursor.execute(
+                    f"INSERT OR IGNORE INTO caption_jobs ({self._COLUMNS}, state, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?)",
+                    row
+                )
+            if cursor.rowcount == 0:
+                # 同一条消息已在队列中
+                with self._lock:
+                    self._depth -= 1
+
+    def _claim(self, limit):
+        """
+        取出最多 limit 个到期的任务并标记为执行中，同时清理过期任务
+
+        :return: (任务列表, 距离下一个任务到期的秒数或 None)
+        """
+        now = int(time.time())
+        with self.db.write() as conn:
+            cursor = conn.cursor()
+            if self.max_age:
+                if self.use_postgres:
+                    cursor.execute("DELETE FROM caption_jobs WHERE state = 'pending' AND enqueued_at < %s", (now - self.max_age,))
+                else:
+                    cursor.execute("DELETE FROM caption_jobs WHERE state = 'pending' AND enqueued_at < ?", (now - self.max_age,))
+                if cursor.rowcount and cursor.rowcount > 0:
+                    with self._lock:
+                        self._depth -= cursor.rowcount
+                        self.expired += cursor.rowcount
+                    logger.warning(f"[Summary] 跳过 {cursor.rowcount} 个排队超过 {self.max_age} 秒的识图任务")
+            if self.use_postgres:
+                cursor.execute(
+                    f"SELECT {self._COLUMNS} FROM caption_jobs WHERE state = 'pending' AND next_attempt_at <= %s ORDER BY next_attempt_at LIMIT %s",
+                    (now, limit)
+                )
+            else:
+                cursor.execute(
+                    f"SELECT {self._COLUMNS} FROM caption_jobs WHERE state = 'pending' AND next_attempt_at <= ? ORDER BY next_attempt_at LIMIT ?",
+                    (now, limit)
+                )
+            jobs = [CaptionJob(*row) for row in cursor.fetchall()]
+            keys = [(job.sessionid, job.msgid) for job in jobs]
+            if self.use_postgres:
+                cursor.executemany("UPDATE caption_jobs SET state = 'running' WHERE sessionid = %s AND msgid = %s", keys)
+            else:
+                cursor.executemany("UPDATE caption_jobs SET state = 'running' WHERE sessionid = ? AND msgid = ?", keys)
+            cursor.execute("SELECT MIN(next_attempt_at) FROM caption_jobs WHERE state = 'pending'")
+            next_at = cursor.fetchone()[0]
+        return jobs, (max(0, next_at - now) if next_at is not None else None)
+
+    def _finish(self, job, result, error=None):
+        """记录任务结果：完成或失败的任务删除，需要重试的任务按指数退避重新排队"""
+        attempts = job.attempts + 1
+        if result == JOB_RETRY and attempts < self.max_attempts:
+            delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+            row = (attempts, int(time.time() + delay), error, job.sessionid, job.msgid)
+            with self.db.write() as conn:
+                if self.use_postgres:
+                    conn.cursor().execute(
+                        "UPDATE caption_jobs SET state = 'pending', attempts = %s, next_attempt_at = %s, last_error = %s WHERE sessionid = %s AND msgid = %s",
+                        row
+                    )
+                else:
+                    conn.cursor().execute(
+                        "UPDATE caption_jobs SET state = 'pending', attempts = ?, next_attempt_at = ?, last_error = ? WHERE sessionid = ? AND msgid = ?",
+                        row
+                    )
+            with self._lock:
+                self.retried += 1
+            logger.info(f"[Summary] 识图任务 {job.msgid} 第 {attempts} 次失败，{delay} 秒后重试")
+            return
+
+        with self.db.write() as conn:
+            if self.use_postgres:
+                conn.cursor().execute("DELETE FROM caption_jobs WHERE sessionid = %s AND msgid = %s", (job.sessionid, job.msgid))
+            else:
+                conn.cursor().execute("DELETE FROM caption_jobs WHERE sessionid = ? AND msgid = ?", (job.sessionid, job.msgid))
+        with self._lock:
+            self._depth -= 1
+            if result == JOB_DONE:
+                self.completed += 1
+            else:
+                self.failed += 1
+        if result != JOB_DONE:
+            logger.error(f"[Summary] 识图任务 {job.msgid} 放弃，共尝试 {attempts} 次: {error}")
+
+    async def _dispatch(self):
+        self._wake = asyncio.Event()
+        while not self._closed:
+            self._wake.clear()
+            wait = _IDLE_INTERVAL
+            free = self.concurrency - len(self._running)
+            if free > 0:
+                try:
+                    jobs, next_due = await self.engine.run_blocking(self._claim, free)
+                except Exception as e:
+                    logger.error(f"[Summary] 读取识图任务失败: {e}")
+                    jobs, next_due = [], None
+                for job in jobs:
+                    task = asyncio.ensure_future(self._work(job))
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+                if next_due is not None:
+                    wait = min(wait, next_due)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=max(wait, 0.05))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _work(self, job):
+        error = None
+        try:
+            result = await self.handler(job)
+        except Exception as e:
+            result, error = JOB_RETRY, str(e)
+        if isinstance(result, tuple):
+            result, error = result
+        try:
+            await self.engine.run_blocking(self._finish, job, result, error)
+        except Exception as e:
+            logger.error(f"[Summary] 更新识图任务状态失败: {e}")
+        self._wake.set()
+
+    def stats(self):
+        """队列深度、执行中的任务数、最早排队任务的等待时间和各类结果计数"""
+        oldest_age = None
+        try:
+            with self.db.read() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT MIN(enqueued_at) FROM caption_jobs WHERE state = 'pending'")
+                oldest = cursor.fetchone()[0]
+            if oldest is not None:
+                oldest_age = max(0, int(time.time()) - oldest)
+        except Exception as e:
+            logger.debug(f"[Summary] 读取识图队列指标失败: {e}")
+        with self._lock:
+            return {
+                "depth": self._depth,
+                "running": len(self._running),
+                "max_pending": self.max_pending,
+                "oldest_job_age": oldest_age,
+                "enqueued": self.enqueued,
+                "completed": self.completed,
+                "retried": self.retried,
+                "failed": self.failed,
+                "expired": self.expired,
+                "rejected": self.rejected,
+            }
@@ -0,0 +1,239 @@
+# encoding:utf-8
+
+import asyncio
+import threading
+import time
+
+from common.log import logger
+
+
+def is_endpoint_failure(status_code):
+    """该状态码是否说明端点本身不可用（鉴权失败、限流或服务端错误），而不是请求有问题"""
+    return status_code in (401, 403, 429) or status_code >= 500
+
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    连续失败 failure_threshold 次后打开，reset_timeout 秒内不再使用该端点；
+    之后进入半开状态，只放行一个探测请求，成功则关闭，失败则重新打开。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.trips = 0
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """是否可以向该端点发送请求；半开状态下放行的请求就是探测请求"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self._probing = False
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def release(self):
+        """放行的请求被取消、没有结果时调用，允许下一个探测请求"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+        """记录一次失败，返回熔断器是否因此打开"""
+        with self._lock:
+            self.failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self.trips += 1
+                return True
+            return False
+
+
+class CompletionEndpoint:
+    """一个聊天补全端点：API 地址、Key、模型以及它的熔断器"""
+
+    __slots__ = ("api_base", "api_key", "model", "breaker")
+
+    def __init__(self, api_base, api_key, model, breaker):
+        self.api_base = api_base.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.breaker = breaker
+
+
+class EndpointRouter:
+    """
+    在按顺序排列的多个聊天补全端点之间对冲和故障转移
+
+    - 熔断器打开的端点不参与轮换；全部不可用时仍尝试第一个端点，避免完全停止服务
+    - 流式请求的主端点超过其首字节耗时的 hedge_percentile 分位数（不低于 hedge_min_delay 秒，没有历史数据时为
+      hedge_max_delay 秒）仍未返回时，向下一个可用端点发送对冲请求，先成功返回的一方胜出，另一方被取消。
+      非流式请求要等生成结束才返回响应头，没有可用于判断端点是否卡住的首字节耗时，只做故障转移
+    - 请求失败时切换到下一个可用端点
+    """
+
+    def __init__(self, endpoints, http_client, hedge_enabled=True, hedge_percentile=95, hedge_min_delay=1.0, hedge_max_delay=10.0):
+        if not endpoints:
+            raise ValueError("至少需要一个聊天补全端点")
+        self.endpoints = endpoints
+        self.http = http_client
+        self.hedge_enabled = hedge_enabled and len(endpoints) > 1
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_delay = hedge_max_delay
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+
+    @property
+    def primary(self):
+        return self.endpoints[0]
+
+    def hedge_delay(self, endpoint):
+        """发送对冲请求前等待的秒数；没有历史数据时使用 hedge_max_delay，有数据时不早于观测到的分位数"""
+        stats = self.http.endpoint_stats(self.http.endpoint_of(endpoint.api_base))
+        first_byte_ms = stats.percentile(self.hedge_percentile, first_byte=True)
+        if first_byte_ms is None:
+            return self.hedge_max_delay
+        return max(first_byte_ms / 1000, self.hedge_min_delay)
+
+    def _next_endpoint(self, tried):
+        for endpoint in self.endpoints:
+            if endpoint not in tried and endpoint.breaker.allow():
+                return endpoint
+        return None
+
+    async def post(self, send, hedge=True):
+        """
+        发送一次聊天补全请求
+
+        :param send: 协程函数 send(endpoint, claim) -> LLMResponse。流式请求每收到一行都应先调用 claim()：
+                     第一个调用的请求胜出，其余请求被取消；返回 False 表示这一行应丢弃
+        :param hedge: 是否允许对冲，只应对流式请求开启
+        :return: (端点, LLMResponse)；所有端点都失败时返回最后一个响应，或抛出最后一个异常
+        """
+        loop = asyncio.get_running_loop()
+        hedge = hedge and self.hedge_enabled
+        tasks = {}
+        tried = []
+        hedged = set()
+        winner = None
+        last_endpoint = last_response = last_error = None
+
+        def cancel_others(keep):
+            for task, endpoint in tasks.items():
+                if endpoint is not keep:
+                    task.cancel()
+
+        def launch(endpoint):
+            def claim():
+                nonlocal winner
+                if winner is None:
+                    winner = endpoint
+                    cancel_others(endpoint)
+                return winner is endpoint
+
+            tasks[asyncio.ensure_future(send(endpoint, claim))] = endpoint
+            tried.append(endpoint)
+            return loop.time() + self.hedge_delay(endpoint) if hedge else None
+
+        hedge_at = launch(self._next_endpoint(tried) or self.primary)
+        try:
+            while tasks:
+                timeout = None
+                if hedge_at is not None and winner is None:
+                    timeout = max(0.0, hedge_at - loop.time())
+                done, _ = await asyncio.wait(list(tasks), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    hedge_at = None
+                    endpoint = self._next_endpoint(tried)
+                    if endpoint is not None:
+                        self.hedges += 1
+                        hedged.add(endpoint.api_base)
+                        logger.info(f"[LLMClient] {tried[-1].api_base} 未及时响应，向 {endpoint.api_base} 发送对冲请求")
+                        launch(endpoint)
+                    continue
+
+                for task in done:
+                    endpoint = tasks.pop(task)
+                    if task.cancelled():
+                        endpoint.breaker.release()
+                        continue
+                    error = task.exception()
+                    response = None if error is not None else task.result()
+                    if response is not None and response.status_code < 400 and winner in (None, endpoint):
+                        endpoint.breaker.record_success()
+                        if endpoint.api_base in hedged:
+                            self.hedge_wins += 1
+                        return endpoint, response
+
+                    if error is not None or is_endpoint_failure(response.status_code):
+                        if endpoint.breaker.record_failure():
+                            logger.warning(f"[LLMClient] 端点 {endpoint.api_base} 连续失败，熔断 {endpoint.breaker.reset_timeout} 秒")
+                    else:
+                        endpoint.breaker.record_success()
+                    last_endpoint, last_response, last_error = endpoint, response, error
+
+                if winner is not None and winner not in tasks.values():
+                    # 流式输出已经开始的请求失败了，不能再切换端点
+                    break
+                if not tasks:
+                    if last_error is None and not is_endpoint_failure(last_response.status_code):
+                        # 请求本身有误（如 400/404），换端点也不会成功，直接返回
+                        break
+                    endpoint = self._next_endpoint(tried)
+                    if endpoint is not None:
+                        self.failovers += 1
+                        logger.warning(f"[LLMClient] {last_endpoint.api_base} 请求失败，切换到 {endpoint.api_base}")
+                        hedge_at = launch(endpoint)
+        finally:
+            for task, endpoint in tasks.items():
+                task.cancel()
+                endpoint.breaker.release()
+
+        if last_response is None:
+            raise last_error
+        return last_endpoint, last_response
+
+    def stats(self):
+        return {
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "endpoints": [
+                {
+                    "api_base": endpoint.api_base,
+                    "model": endpoint.model,
+                    "state": endpoint.breaker.state,
+                    "failures": endpoint.breaker.failures,
+                    "trips": endpoint.breaker.trips,
+                    "hedge_delay": round(self.hedge_delay(endpoint), 2),
+                }
+                for endpoint in self.endpoints
+            ],
+        }
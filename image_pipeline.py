@@ -0,0 +1,61 @@
+# encoding:utf-8
+
+import base64
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+from common.log import logger
+
+# 编码结果超过大小上限时依次尝试的 JPEG 质量
+_JPEG_QUALITIES = (85, 70, 50)
+
+
+def load_image(image_path, max_side=1024):
+    """
+    解码图片并缩小到最长边不超过 max_side，整个流程只解码一次
+
+    - JPEG 通过 draft() 在解码时直接按 1/2、1/4、1/8 缩放（DCT 域缩放），不解码全尺寸像素
+    - 其他格式先用 reduce() 按整数倍快速缩小，再由 thumbnail() 缩放到目标尺寸
+
+    :return: RGB 或灰度模式的 PIL 图片，失败时返回 None
+    """
+    try:
+        with Image.open(image_path) as img:
+            original_size = img.size
+            img.draft("RGB", (max_side, max_side))
+            factor = min(img.size) and max(img.size) // max_side
+            if factor >= 2:
+                img = img.reduce(factor)
+            img.thumbnail((max_side, max_side), reducing_gap=2.0)
+            # 手机照片的方向保存在 EXIF 中，缩小后再旋转开销更小
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ("RGB", "L"):
+                img = img.convert("RGB")
+            img.load()
+        logger.debug(f"[Summary] 图片 {original_size} 缩放为 {img.size}")
+        return img
+    except Exception as e:
+        logger.error(f"[Summary] 图片处理失败: {e}")
+        return None
+
+
+def encode_image(img, max_bytes=1024 * 1024):
+    """
+    把图片编码为 JPEG 后转 base64；超过 max_bytes 时逐步降低质量，仍然超过则放弃
+
+    :return: base64 字符串，图片太大时返回 None
+    """
+    buffer = BytesIO()
+    for quality in _JPEG_QUALITIES:
+        buffer.seek(0)
+        buffer.truncate()
+        img.save(buffer, format="JPEG", quality=quality)
+        if buffer.tell() <= max_bytes:
+            break
+    else:
+        logger.warning(f"[Summary] 图片压缩后仍超过 {max_bytes} 字节，放弃识图")
+        return None
+    # getbuffer() 直接引用缓冲区内容，避免再复制一份字节
+    return base64.b64encode(buffer.getbuffer()).decode("ascii")
+
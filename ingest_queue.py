@@ -0,0 +1,185 @@
+# encoding:utf-8
+
+import threading
+import time
+from collections import deque
+
+from common.log import logger
+
+
+class WriteBehindQueue:
+    """
+    写后（write-behind）入库队列
+
+    消息先进入有界的内存缓冲区，由独立的写线程在达到数量阈值或时间阈值时
+    调用 flush_func 批量写入数据库，避免每条消息一次事务提交。
+    """
+
+    def __init__(self, flush_func, batch_size=200, flush_interval=1.0, max_size=10000, max_retries=3, name="ingest"):
+        """
+        :param flush_func: 批量写入函数，参数为记录列表，失败时应抛出异常
+        :param batch_size: 单批最大记录数，缓冲区达到该数量时立即触发写入
+        :param flush_interval: 最长等待时间（秒），超过后即使未满一批也会写入
+        :param max_size: 缓冲区上限，写满后 put 会阻塞等待写线程消化
+        :param max_retries: 同一批次写入失败的最大重试次数，超过后丢弃并记录错误
+        """
+        self.flush_func = flush_func
+        self.batch_size = max(1, int(batch_size))
+        self.flush_interval = max(0.01, float(flush_interval))
+        self.max_size = max(self.batch_size, int(max_size))
+        self.max_retries = max_retries
+        self.name = name
+
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._pending_batch = None  # 写入失败、等待重试的批次
+        self._pending_attempts = 0
+        self._enqueued = 0  # 已入队的记录序号
+        self._written = 0   # 已处理完成（写入或丢弃）的记录序号
+        self._flush_requested = False
+        self._stopped = False
+
+        # 指标
+        self._flushed_records = 0
+        self._flushed_batches = 0
+        self._dropped_records = 0
+        self._failed_flushes = 0
+        self._last_flush_ms = 0.0
+        self._max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+        self._thread = threading.Thread(target=self._run, name=f"summary-{name}-writer", daemon=True)
+        self._thread.start()
+
+    def put(self, record):
+        """将一条记录放入缓冲区，缓冲区已满时阻塞直到写线程腾出空间"""
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError(f"[Summary] {self.name} 队列已关闭")
+            while len(self._buffer) >= self.max_size and not self._stopped:
+                self._flush_requested = True
+                self._cond.notify_all()
+                self._cond.wait(0.5)
+            self._buffer.append(record)
+            self._enqueued += 1
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify_all()
+
+    def flush(self, timeout=10.0):
+        """
+        立即写出当前缓冲区中的所有记录，并等待写入完成
+
+        :return: 是否在超时前完成
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            target = self._enqueued
+            self._flush_requested = True
+            self._cond.notify_all()
+            while self._written < target and self._thread.is_alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return self._written >= target
+
+    def stop(self, timeout=10.0):
+        """停止写线程，退出前写出缓冲区中剩余的记录"""
+        with self._cond:
+            if self._stopped:
+                return
+            self._stopped = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning(f"[Summary] {self.name} 写线程未能在 {timeout} 秒内退出，剩余 {len(self._buffer)} 条记录")
+        else:
+            logger.info(f"[Summary] {self.name} 写线程已退出，共写入 {self._flushed_records} 条记录")
+
+    def depth(self):
+        """当前缓冲区中等待写入的记录数"""
+        with self._cond:
+            return len(self._buffer) + (len(self._pending_batch) if self._pending_batch else 0)
+
+    def stats(self):
+        """返回队列深度和写入延迟等指标"""
+        with self._cond:
+            batches = self._flushed_batches
+            return {
+                "queue_depth": len(self._buffer) + (len(self._pending_batch) if self._pending_batch else 0),
+                "max_size": self.max_size,
+                "flushed_records": self._flushed_records,
+                "flushed_batches": batches,
+                "dropped_records": self._dropped_records,
+                "failed_flushes": self._failed_flushes,
+                "last_flush_ms": round(self._last_flush_ms, 2),
+                "max_flush_ms": round(self._max_flush_ms, 2),
+                "avg_flush_ms": round(self._total_flush_ms / batches, 2) if batches else 0.0,
+            }
+
+    def _next_batch(self):
+        """在持有锁的情况下取出下一批记录，没有需要写入的记录时等待"""
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            if self._pending_batch:
+                return self._pending_batch
+            if self._buffer and (self._stopped or self._flush_requested or len(self._buffer) >= self.batch_size):
+                break
+            if self._stopped:
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if self._buffer:
+                    break
+                deadline = time.monotonic() + self.flush_interval
+                remaining = self.flush_interval
+            self._cond.wait(remaining)
+
+        count = min(len(self._buffer), self.batch_size)
+        batch = [self._buffer.popleft() for _ in range(count)]
+        if not self._buffer:
+            self._flush_requested = False
+        self._cond.notify_all()  # 唤醒因缓冲区已满而阻塞的生产者
+        return batch
+
+    def _run(self):
+        while True:
+            with self._cond:
+                batch = self._next_batch()
+            if batch is None:
+                return
+
+            start = time.perf_counter()
+            try:
+                self.flush_func(batch)
+            except Exception as e:
+                with self._cond:
+                    self._failed_flushes += 1
+                    self._pending_attempts += 1
+                    if self._pending_attempts > self.max_retries:
+                        logger.error(f"[Summary] {self.name} 批量写入失败 {self._pending_attempts} 次，丢弃 {len(batch)} 条记录: {e}")
+                        self._dropped_records += len(batch)
+                        self._written += len(batch)
+                        self._pending_batch = None
+                        self._pending_attempts = 0
+                        self._cond.notify_all()
+                    else:
+                        logger.warning(f"[Summary] {self.name} 批量写入失败，稍后重试（第 {self._pending_attempts} 次）: {e}")
+                        self._pending_batch = batch
+                        # 退避一段时间再重试，关闭时不再等待
+                        if not self._stopped:
+                            self._cond.wait(min(self.flush_interval * self._pending_attempts, 5.0))
+                continue
+
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            with self._cond:
+                self._pending_batch = None
+                self._pending_attempts = 0
+                self._written += len(batch)
+                self._flushed_records += len(batch)
+                self._flushed_batches += 1
+                self._last_flush_ms = elapsed_ms
+                self._max_flush_ms = max(self._max_flush_ms, elapsed_ms)
+                self._total_flush_ms += elapsed_ms
+                self._cond.notify_all()
+            logger.debug(f"[Summary] {self.name} 批量写入 {len(batch)} 条记录，耗时 {elapsed_ms:.1f}ms")
@@ -0,0 +1,179 @@
+# encoding:utf-8
+
+import email.utils
+import random
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common.log import logger
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class EndpointStats:
+    """单个 API 端点的调用统计，保留最近若干次调用的耗时和流式请求的首字节耗时用于计算分位数"""
+
+    def __init__(self, window=200):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.latencies = deque(maxlen=window)
+        self.first_byte_latencies = deque(maxlen=window)
+
+    def percentile(self, p, first_byte=False):
+        """最近调用耗时（first_byte 为 True 时为首字节耗时）的 p 分位数（毫秒），没有数据时返回 None"""
+        samples = self.first_byte_latencies if first_byte else self.latencies
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+        return round(ordered[index], 1)
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "first_byte_p95_ms": self.percentile(95, first_byte=True),
+        }
+
+
+class LLMHttpClient:
+    """
+    LLM 接口共用的 HTTP 客户端
+
+    - 每个 API 地址（scheme://host）复用一个带连接池的 requests.Session，保持长连接
+    - 所有请求都设置连接超时和读取超时
+    - 429/5xx 和连接失败时按带抖动的指数退避重试，优先遵循响应中的 Retry-After
+    - 记录每个端点的调用次数、错误、重试和耗时分位数
+    """
+
+    def __init__(self, connect_timeout=10, read_timeout=120, max_retries=3, backoff_base=1.0, backoff_max=30.0, pool_maxsize=20):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_maxsize = pool_maxsize
+
+        self._sessions = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def endpoint_of(url):
+        parsed = urlparse(url)
+        return f"{parsed.scheme}://{parsed.netloc}"
+
+    def _session(self, endpoint):
+        with self._lock:
+            session = self._sessions.get(endpoint)
+            if session is None:
+                session = requests.Session()
+                # 重试由本类控制，适配器本身不重试
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=0)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[endpoint] = session
+            return session
+
+    def endpoint_stats(self, endpoint):
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats()
+            return stats
+
+    def record(self, endpoint, elapsed_ms=None, error=False, retry=False, first_byte_ms=None):
+        """记录一次调用结果；elapsed_ms 为 None 表示请求未得到响应"""
+        stats = self.endpoint_stats(endpoint)
+        with self._lock:
+            if retry:
+                stats.retries += 1
+                return
+            stats.calls += 1
+            if error:
+                stats.errors += 1
+            if elapsed_ms is not None:
+                stats.latencies.append(elapsed_ms)
+            if first_byte_ms is not None:
+                stats.first_byte_latencies.append(first_byte_ms)
+
+    def retry_delay(self, attempt, headers=None):
+        """
+        计算第 attempt 次重试前的等待秒数
+
+        :param headers: 上一次响应的响应头，包含 Retry-After 时优先使用
+        """
+        if headers is not None:
+            retry_after = headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.backoff_max)
+                except ValueError:
+                    try:
+                        retry_at = email.utils.parsedate_to_datetime(retry_after).timestamp()
+                        return min(max(retry_at - time.time(), 0), self.backoff_max)
+                    except (TypeError, ValueError):
+                        pass
+        # full jitter：在 [0, base * 2^attempt] 之间随机等待
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def post(self, url, headers=None, json=None, timeout=None, stream=False):
+        """
+        发送 POST 请求，按重试策略处理 429/5xx 和连接失败
+
+        :param timeout: 读取超时（秒），默认使用 read_timeout
+        :return: 最后一次请求的 requests.Response（可能是非 2xx 响应）
+        """
+        endpoint = self.endpoint_of(url)
+        session = self._session(endpoint)
+        timeouts = (self.connect_timeout, timeout or self.read_timeout)
+
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = session.post(url, headers=headers, json=json, timeout=timeouts, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout) as e:
+                self.record(endpoint, error=True)
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_delay(attempt)
+                logger.warning(f"[LLMClient] 请求 {endpoint} 失败，{delay:.1f} 秒后重试（第 {attempt + 1} 次）: {e}")
+            except requests.exceptions.RequestException:
+                self.record(endpoint, error=True)
+                raise
+            else:
+                elapsed_ms = (time.perf_counter() - start) * 1000
+                # response.elapsed 是从发出请求到解析完响应头的耗时；非流式请求的响应头在生成结束后才返回，不计入首字节耗时
+                self.record(endpoint, elapsed_ms, error=response.status_code >= 400,
+                            first_byte_ms=response.elapsed.total_seconds() * 1000 if stream else None)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    logger.debug(f"[LLMClient] 请求 {endpoint} 完成，状态码 {response.status_code}，耗时 {elapsed_ms:.0f}ms")
+                    return response
+                delay = self.retry_delay(attempt, response.headers)
+                logger.warning(f"[LLMClient] 请求 {endpoint} 返回 {response.status_code}，{delay:.1f} 秒后重试（第 {attempt + 1} 次）")
+                response.close()
+
+            self.record(endpoint, retry=True)
+            attempt += 1
+            time.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            return {endpoint: stats.to_dict() for endpoint, stats in self._stats.items()}
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
@@ -0,0 +1,198 @@
+# encoding:utf-8
+
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from common.log import logger
+
+from .llm_client import RETRY_STATUS_CODES
+
+
+class LLMResponse:
+    """LLM 接口响应，提供与 requests.Response 相同的常用属性"""
+
+    __slots__ = ("status_code", "text", "headers")
+
+    def __init__(self, status_code, text, headers):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class LLMEngine:
+    """
+    基于 asyncio 的 LLM 调用引擎
+
+    事件循环运行在一个后台线程中，所有 LLM 请求以协程形式提交到该循环，
+    由全局并发上限和每个 API 地址的并发上限共同限流。等待响应不占用线程，
+    大量并发的总结和识图请求只需要少量线程。
+    重试策略、超时和端点统计与 LLMHttpClient 保持一致。
+    """
+
+    def __init__(self, http_client, max_concurrency=32, endpoint_concurrency=8, blocking_workers=4):
+        """
+        :param http_client: LLMHttpClient，提供超时、重试策略和端点统计
+        :param blocking_workers: 执行图片解码等阻塞操作的线程数
+        """
+        self.http = http_client
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.endpoint_concurrency = max(1, int(endpoint_concurrency))
+        self._executor = ThreadPoolExecutor(max_workers=blocking_workers, thread_name_prefix="summary-llm-blocking")
+        self._endpoint_limits = {}
+        self._sessions = {}
+        self._active = {}  # endpoint -> 正在进行的请求数
+        self._waiting = 0
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run_loop, name="summary-llm-engine", daemon=True)
+        self._thread.start()
+        # 信号量需要在事件循环内创建
+        self._global_limit = self.run(self._create_semaphore(self.max_concurrency))
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    @staticmethod
+    async def _create_semaphore(value):
+        return asyncio.Semaphore(value)
+
+    def submit(self, coro):
+        """提交协程到引擎，返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro, timeout=None):
+        """提交协程并阻塞等待结果，不能在引擎的事件循环线程中调用"""
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("[Summary] 不能在 LLM 引擎线程中同步等待")
+        return self.submit(coro).result(timeout)
+
+    async def run_blocking(self, fn, *args):
+        """在线程池中执行阻塞函数（如图片解码），不阻塞事件循环"""
+        return await self.loop.run_in_executor(self._executor, fn, *args)
+
+    def _endpoint_limit(self, endpoint):
+        limit = self._endpoint_limits.get(endpoint)
+        if limit is None:
+            limit = self._endpoint_limits[endpoint] = asyncio.Semaphore(self.endpoint_concurrency)
+        return limit
+
+    def _session(self, endpoint):
+        session = self._sessions.get(endpoint)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=0, limit_per_host=self.endpoint_concurrency, keepalive_timeout=60)
+            session = self._sessions[endpoint] = aiohttp.ClientSession(connector=connector)
+        return session
+
+    async def post(self, url, headers=None, json=None, timeout=None, on_line=None):
+        """
+        发送 POST 请求，按 LLMHttpClient 的策略处理 429/5xx 和连接失败
+
+        :param timeout: 读取超时（秒），默认使用 http_client.read_timeout；流式请求中为两次读取之间的最长间隔
+        :param on_line: 可选的协程函数，响应为 200 时逐行接收响应体（用于 SSE 流式响应），
+                        此时返回的 LLMResponse.text 为空；已经开始接收后连接中断不再重试
+        :return: 最后一次请求的 LLMResponse（可能是非 2xx 响应）
+        """
+        endpoint = self.http.endpoint_of(url)
+        client_timeout = aiohttp.ClientTimeout(
+            sock_connect=self.http.connect_timeout,
+            sock_read=timeout or self.http.read_timeout,
+        )
+
+        streamed = False
+        consume = None
+        if on_line is not None:
+            async def consume(line):
+                nonlocal streamed
+                streamed = True
+                await on_line(line)
+
+        attempt = 0
+        while True:
+            try:
+                response, elapsed_ms, first_byte_ms = await self._send(endpoint, url, headers, json, client_timeout, consume)
+            except asyncio.TimeoutError:
+                # 与同步客户端一致：读取超时不重试
+                self.http.record(endpoint, error=True)
+                raise
+            except aiohttp.ClientConnectionError as e:
+                self.http.record(endpoint, error=True)
+                if attempt >= self.http.max_retries or streamed:
+                    raise
+                delay = self.http.retry_delay(attempt)
+                logger.warning(f"[LLMClient] 请求 {endpoint} 失败，{delay:.1f} 秒后重试（第 {attempt + 1} 次）: {e}")
+            except aiohttp.ClientError:
+                self.http.record(endpoint, error=True)
+                raise
+            else:
+                # 非流式请求的响应头在生成结束后才返回，不计入首字节耗时
+                self.http.record(endpoint, elapsed_ms, error=response.status_code >= 400,
+                                 first_byte_ms=first_byte_ms if on_line is not None else None)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.http.max_retries:
+                    logger.debug(f"[LLMClient] 请求 {endpoint} 完成，状态码 {response.status_code}，耗时 {elapsed_ms:.0f}ms")
+                    return response
+                delay = self.http.retry_delay(attempt, response.headers)
+                logger.warning(f"[LLMClient] 请求 {endpoint} 返回 {response.status_code}，{delay:.1f} 秒后重试（第 {attempt + 1} 次）")
+
+            self.http.record(endpoint, retry=True)
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def _send(self, endpoint, url, headers, json, client_timeout, on_line=None):
+        """在并发上限内发送一次请求，返回 (LLMResponse, 耗时毫秒, 收到响应头的耗时毫秒)"""
+        self._waiting += 1
+        acquired = False
+        try:
+            async with self._global_limit, self._endpoint_limit(endpoint):
+                self._waiting -= 1
+                acquired = True
+                self._active[endpoint] = self._active.get(endpoint, 0) + 1
+                try:
+                    start = time.perf_counter()
+                    async with self._session(endpoint).post(url, headers=headers, json=json, timeout=client_timeout) as resp:
+                        first_byte_ms = (time.perf_counter() - start) * 1000
+                        if on_line is not None and resp.status == 200:
+                            async for raw in resp.content:
+                                await on_line(raw.decode("utf-8").rstrip("\r\n"))
+                            response = LLMResponse(resp.status, "", resp.headers)
+                        else:
+                            response = LLMResponse(resp.status, await resp.text(), resp.headers)
+                    return response, (time.perf_counter() - start) * 1000, first_byte_ms
+                finally:
+                    self._active[endpoint] -= 1
+        finally:
+            if not acquired:
+                self._waiting -= 1
+
+    def stats(self):
+        return {
+            "max_concurrency": self.max_concurrency,
+            "endpoint_concurrency": self.endpoint_concurrency,
+            "waiting": self._waiting,
+            "active": dict(self._active),
+        }
+
+    async def _close_sessions(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+    def close(self, timeout=5):
+        """关闭 HTTP 会话并停止事件循环"""
+        if not self.loop.is_running():
+            return
+        try:
+            self.run(self._close_sessions(), timeout)
+        except Exception as e:
+            logger.warning(f"[Summary] 关闭 LLM 引擎会话失败: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self._executor.shutdown(wait=False)
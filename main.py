@@ -1,18 +1,16 @@
 # encoding:utf-8
 
 import asyncio
+import atexit
+import hashlib
 import json
 import os
 import time
 import sqlite3
-import requests
+import aiohttp
 from urllib.parse import urlparse
-from concurrent.futures import ThreadPoolExecutor
-import base64
-from io import BytesIO
-from PIL import Image
 import psycopg2  # 添加 PostgreSQL 连接库
-import re  # 用于解析连接字符串
+import psycopg2.extras
 import urllib.parse
 
 import plugins
@@ -22,6 +20,22 @@ from channel.chat_channel import check_contain, check_prefix
 from channel.chat_message import ChatMessage
 from common.log import logger
 from plugins import *
+from .cache import LRUCache
+from .caption_batcher import BATCH_CAPTION_PROMPT, CaptionBatcher, split_batch_captions
+from .caption_cache import CaptionCache
+from .caption_jobs import JOB_DONE, JOB_FAILED, JOB_RETRY, CaptionJob, CaptionJobQueue
+from .failover import CircuitBreaker, CompletionEndpoint, EndpointRouter
+from .image_pipeline import encode_image, load_image
+from .ingest_queue import WriteBehindQueue
+from .llm_client import LLMHttpClient
+from .llm_engine import LLMEngine
+from .message_parser import MSG_IMAGE, MSG_MUSIC, MSG_SHARE, MSG_VIDEO, classify_message
+from .scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_LINK, RateLimitExceeded, get_shared_scheduler
+from .session_meta import SessionMetaCache
+from .singleflight import SingleFlight
+from .streaming import TopicStreamer, parse_sse_delta
+from .tokens import TokenCounter
+from .storage import CHAT_RECORD_COLUMNS, POSTGRES_CHAT_RECORDS_DDL, PostgresStore, SQLiteStore, copy_upsert_chat_records
 
 
 @plugins.register(
@@ -70,6 +84,24 @@ class Summary(Plugin):
 如果是文字截图，只关注文字内容，不用描述图的颜色颜色等；
 如果图中有划线，画圈等，要注意这可能是表达的重点信息。
             """
+    default_merge_prompt = '''
+你将收到同一段聊天记录按时间顺序切分后分别生成的多段总结，请把它们合并成一份完整的总结：
+1. 用户特定指令:{custom_prompt}，指令不为无时优先遵循用户特定指令；
+2. 不同分段中属于同一主题/话题的内容要合并，时间范围取并集，参与者去重，热度综合评估；
+3. 不要遗漏分段总结中的重要信息（关键字/数据/观点/结论等），不要提及"分段"；
+4. 按时间先后排序，保持分段总结中的格式：
+    1️⃣[Topic][热度(用1-5个🔥表示)]
+    • 时间：月-日 时:分 - -日 时:分(不显示年)
+    • 参与者：
+    • 内容：
+    • 结论：
+    ………
+'''
+    default_incremental_prompt = '''
+**增量更新：**
+用户消息中【之前的总结】是对较早聊天记录的总结，【新增聊天记录】是之前的总结没有覆盖的聊天记录。
+请在之前的总结基础上合并新增聊天记录，输出一份完整的、更新后的总结：属于已有话题的内容并入该话题并更新时间、参与者和结论，新的话题按时间顺序补充。
+'''
     #新增的多模态LLM配置
     multimodal_llm_api_base = ""
     multimodal_llm_model = ""
@@ -92,10 +124,36 @@ class Summary(Plugin):
             # 修改变量名
             self.summary_max_tokens = self.config.get("max_tokens", self.summary_max_tokens)
             self.input_max_tokens_limit = self.config.get("max_input_tokens", self.input_max_tokens_limit)
+            # token 计数：token_vocab_path（默认插件目录下的 <编码>.tiktoken）存在时用 tiktoken 精确计数，否则按字符类别估算
+            token_encoding = self.config.get("token_encoding", "cl100k_base")
+            self.token_counter = TokenCounter(
+                token_encoding,
+                self.config.get("token_vocab_path") or os.path.join(os.path.dirname(__file__), f"{token_encoding}.tiktoken"),
+                self.config.get("token_cache_size", 65536),
+            )
+            logger.info(f"[Summary] token 计数方式: {self.token_counter.backend}")
 
             #加载提示词，优先读取配置，否则用默认的
             self.default_summary_prompt = self.config.get("default_summary_prompt", self.default_summary_prompt)
             self.default_image_prompt = self.config.get("default_image_prompt", self.default_image_prompt)
+            self.default_merge_prompt = self.config.get("default_merge_prompt", self.default_merge_prompt)
+            # 聊天记录超过输入上限时分段总结（map），再合并（reduce）
+            self.max_summary_chunks = self.config.get("max_summary_chunks", 10)
+            # 按 token 预算读取聊天记录时每批取回的行数
+            self.record_fetch_batch_size = self.config.get("record_fetch_batch_size", 200)
+            self.summary_map_concurrency = self.config.get("summary_map_concurrency", 4)
+            # 增量总结：复用同一会话上一次的总结，只把之后新增的聊天记录发给 LLM
+            self.default_incremental_prompt = self.config.get("default_incremental_prompt", self.default_incremental_prompt)
+            self.summary_checkpoint_enabled = self.config.get("summary_checkpoint_enabled", True)
+            self.summary_checkpoint_tolerance = self.config.get("summary_checkpoint_tolerance", 0.1)
+            # 总结结果缓存：相同会话、相同消息范围、相同提示词和模型的请求直接返回缓存结果
+            self.summary_cache_ttl = self.config.get("summary_cache_ttl", 600)
+            self.summary_cache_persist = self.config.get("summary_cache_persist", False)
+            self.summary_cache = LRUCache(self.config.get("summary_cache_size", 256), ttl=self.summary_cache_ttl)
+            # 合并进行中的相同总结请求，只调用一次 LLM
+            self.summary_flight = SingleFlight()
+            # 流式总结：边生成边按主题分条发送，缩短等待第一条消息的时间
+            self.summary_stream = self.config.get("summary_stream", False)
             # 新增 chunk_max_tokens 从 config 加载，默认值是 3600
             #self.chunk_max_tokens = self.config.get("max_tokens_persession", 3600)
 
@@ -103,6 +161,19 @@ class Summary(Plugin):
             self.multimodal_llm_api_base = self.config.get("multimodal_llm_api_base", "")
             self.multimodal_llm_model = self.config.get("multimodal_llm_model", "")
             self.multimodal_llm_api_key = self.config.get("multimodal_llm_api_key", "")
+            # 发送给多模态模型前把图片缩小到最长边不超过该值，编码后超过大小上限的图片放弃识图
+            self.multimodal_image_max_side = self.config.get("multimodal_image_max_side", 1024)
+            self.multimodal_image_max_bytes = self.config.get("multimodal_image_max_bytes", 1024 * 1024)
+            # 图片描述缓存：转发到多个群的同一张图（感知哈希相近）直接复用已有描述
+            self.image_caption_cache_enabled = self.config.get("image_caption_cache", True)
+            # 合并识图：同一会话 image_batch_window 秒内的图片最多 image_batch_max_size 张合并为一个请求；
+            # 默认的 GLM-4V-Flash 每次只接受一张图片，因此默认为 1（不合并），换用支持多图的模型后再调大
+            self.caption_batcher = CaptionBatcher(
+                self._describe_image_async,
+                self._describe_images_async,
+                window=self.config.get("image_batch_window", 1.5),
+                max_size=self.config.get("image_batch_max_size", 1),
+            )
             
              # 验证多模态LLM配置
             if self.multimodal_llm_api_base and not self.multimodal_llm_api_key :
@@ -112,23 +183,106 @@ class Summary(Plugin):
             # 检查是否有 PostgreSQL 连接配置
             self.postgres_url = self.config.get("POSTGRES_URL", "")
             self.use_postgres = bool(self.postgres_url)
+            self.postgres_copy_min_batch = self.config.get("postgres_copy_min_batch", 100)
             
             # 初始化数据库连接
             if self.use_postgres:
                 # 使用 PostgreSQL
                 logger.info("[Summary] 使用 PostgreSQL 数据库")
-                self.conn = self._connect_postgres()
+                self.db = self._connect_postgres()
             else:
-                # 使用 SQLite
+                # 使用 SQLite：WAL 模式，读线程各自持有连接，写操作走唯一的写连接
                 logger.info("[Summary] 使用 SQLite 数据库")
                 curdir = os.path.dirname(__file__)
                 db_path = os.path.join(curdir, "chat.db")
-                self.conn = sqlite3.connect(db_path, check_same_thread=False)
+                self.db = SQLiteStore(
+                    db_path,
+                    synchronous=self.config.get("sqlite_synchronous", "NORMAL"),
+                    cache_size_mb=self.config.get("sqlite_cache_size_mb", 64),
+                    mmap_size_mb=self.config.get("sqlite_mmap_size_mb", 256),
+                )
             
+            self.session_meta = SessionMetaCache(self.db, self.use_postgres, self.config.get("session_cache_size", 4096))
+            caption_prompt_key = hashlib.sha1(f"{self.multimodal_llm_model}\0{self.default_image_prompt}".encode("utf-8")).hexdigest()
+            self.caption_cache = CaptionCache(
+                self.db,
+                self.use_postgres,
+                caption_prompt_key,
+                max_size=self.config.get("image_caption_cache_size", 50000),
+                max_distance=self.config.get("image_hash_max_distance", 0),
+                max_detail_distance=self.config.get("image_hash_max_detail_distance", 12),
+            )
+            # 持久化的识图任务队列：有界排队、超时跳过、失败退避重试，重启后继续执行
+            self.caption_jobs = CaptionJobQueue(
+                self.db,
+                self.use_postgres,
+                self._run_caption_job,
+                concurrency=self.config.get("image_job_concurrency", 4),
+                max_pending=self.config.get("image_job_max_pending", 1000),
+                max_age=self.config.get("image_job_max_age", 3600),
+                max_attempts=self.config.get("image_job_max_attempts", 3),
+                retry_base=self.config.get("image_job_retry_base", 5),
+            )
             self._init_database()
 
-             # 初始化线程池
-            self.executor = ThreadPoolExecutor(max_workers=5) #你可以根据实际情况调整线程池大小
+            # 初始化写后入库队列：消息先进入内存缓冲，由写线程批量提交
+            self.ingest_queue = WriteBehindQueue(
+                self._flush_records,
+                batch_size=self.config.get("ingest_batch_size", 200),
+                flush_interval=self.config.get("ingest_flush_interval", 1.0),
+                max_size=self.config.get("ingest_queue_max_size", 10000),
+            )
+            atexit.register(self._shutdown)
+
+            # LLM 调用共用的 HTTP 客户端：按 API 地址复用长连接，设置超时并对 429/5xx 退避重试
+            self.llm_client = LLMHttpClient(
+                connect_timeout=self.config.get("llm_connect_timeout", 10),
+                read_timeout=self.config.get("llm_read_timeout", 120),
+                max_retries=self.config.get("llm_max_retries", 3),
+            )
+            # LLM 请求以协程形式在后台事件循环中并发执行，等待响应不占用线程
+            self.llm_engine = LLMEngine(
+                self.llm_client,
+                max_concurrency=self.config.get("llm_max_concurrency", 32),
+                endpoint_concurrency=self.config.get("llm_endpoint_concurrency", 8),
+            )
+            # 聊天补全端点列表：第一个为主端点，其余用于对冲和故障转移；未配置时只使用 open_ai_api_base
+            endpoint_configs = self.config.get("open_ai_endpoints") or [
+                {"api_base": self.open_ai_api_base, "api_key": self.open_ai_api_key, "model": self.open_ai_model}
+            ]
+            self.completion_router = EndpointRouter(
+                [
+                    CompletionEndpoint(
+                        item["api_base"],
+                        item.get("api_key", self.open_ai_api_key),
+                        item.get("model", self.open_ai_model),
+                        CircuitBreaker(
+                            self.config.get("llm_breaker_failure_threshold", 5),
+                            self.config.get("llm_breaker_reset_timeout", 30),
+                        ),
+                    )
+                    for item in endpoint_configs
+                ],
+                self.llm_client,
+                hedge_enabled=self.config.get("llm_hedge_enabled", True),
+                hedge_percentile=self.config.get("llm_hedge_percentile", 95),
+                hedge_min_delay=self.config.get("llm_hedge_min_delay", 1.0),
+                hedge_max_delay=self.config.get("llm_hedge_max_delay", 10.0),
+            )
+            # 按 API Key 的 rpm/tpm 配额调度请求：$总结 > 链接总结 > 后台识图，配额不足时低优先级请求延后或丢弃
+            self.llm_scheduler = get_shared_scheduler()
+            self.llm_scheduler.configure(
+                rpm=self.config.get("llm_rpm_limit", 0),
+                tpm=self.config.get("llm_tpm_limit", 0),
+                max_wait={
+                    PRIORITY_LINK: self.config.get("llm_link_max_wait", 60),
+                    PRIORITY_BACKGROUND: self.config.get("llm_background_max_wait", 30),
+                },
+                reserve={PRIORITY_BACKGROUND: self.config.get("llm_background_reserve", 0.3)},
+            )
+
+            # 识图任务从持久化队列中取出，在 LLM 引擎中执行；重启前未完成的任务在此恢复
+            self.caption_jobs.start(self.llm_engine)
 
             # 注册事件处理器
             self.handlers[Event.ON_HANDLE_CONTEXT] = self.on_handle_context
@@ -161,16 +315,56 @@ class Summary(Plugin):
                 self.postgres_url = postgres_url
             
             logger.info(f"[Summary] 正在连接到 PostgreSQL (密码已隐藏)")
-            conn = psycopg2.connect(self.postgres_url)
-            return conn
+            return PostgresStore(
+                self.postgres_url,
+                min_size=self.config.get("postgres_pool_min", 1),
+                max_size=self.config.get("postgres_pool_max", 10),
+                statement_timeout_ms=self.config.get("postgres_statement_timeout_ms", 30000),
+                health_check_interval=self.config.get("postgres_health_check_interval", 0),
+            )
         except Exception as e:
             logger.error(f"[Summary] PostgreSQL 连接失败: {e}")
             raise e
 
     def _init_database(self):
         """初始化数据库架构"""
-        cursor = self.conn.cursor()
-        
+        with self.db.write() as conn:
+            self._migrate_schema(conn.cursor())
+        with self.db.write() as conn:
+            self.session_meta.init_schema(conn.cursor())
+            if self.image_caption_cache_enabled:
+                self.caption_cache.init_schema(conn.cursor())
+            self.caption_jobs.init_schema(conn.cursor())
+            conn.cursor().execute('''CREATE TABLE IF NOT EXISTS summary_checkpoints
+                            (sessionid TEXT NOT NULL,
+                            prompt_hash TEXT NOT NULL,
+                            first_timestamp BIGINT,
+                            last_timestamp BIGINT,
+                            last_msgid BIGINT,
+                            summary TEXT,
+                            updated_at BIGINT,
+                            boundary_msgids TEXT,
+                            PRIMARY KEY (sessionid, prompt_hash))''')
+            # 检查点最后一秒内已总结的 msgid，旧版本的表没有该列
+            if self.use_postgres:
+                conn.cursor().execute("ALTER TABLE summary_checkpoints ADD COLUMN IF NOT EXISTS boundary_msgids TEXT")
+            else:
+                cursor = conn.cursor()
+                cursor.execute("PRAGMA table_info(summary_checkpoints);")
+                if 'boundary_msgids' not in [column[1] for column in cursor.fetchall()]:
+                    cursor.execute("ALTER TABLE summary_checkpoints ADD COLUMN boundary_msgids TEXT;")
+            if self.summary_cache_persist:
+                conn.cursor().execute('''CREATE TABLE IF NOT EXISTS summary_cache
+                                (cache_key TEXT PRIMARY KEY,
+                                summary TEXT,
+                                created_at BIGINT)''')
+
+        self._ensure_indexes()
+        self._ensure_search_index()
+        self._check_query_plan()
+
+    def _migrate_schema(self, cursor):
+        """创建 chat_records 表，或为旧版本的表补齐字段"""
         if self.use_postgres:
             try:
                 # 检查表是否存在
@@ -179,20 +373,7 @@ class Summary(Plugin):
                 
                 if not table_exists:
                     # 创建新表，使用新的数据库结构
-                    cursor.execute('''
-                        CREATE TABLE chat_records (
-                            msgid BIGINT NOT NULL,
-                            sessionid TEXT NOT NULL, 
-                            sessionname TEXT,
-                            userid TEXT,
-                            username TEXT,
-                            content TEXT, 
-                            type TEXT, 
-                            timestamp INTEGER, 
-                            is_triggered INTEGER,
-                            PRIMARY KEY (sessionid, msgid)
-                        )
-                    ''')
+                    cursor.execute(POSTGRES_CHAT_RECORDS_DDL)
                 else:
                     # 检查 msgid 列的数据类型
                     cursor.execute('''
@@ -230,6 +411,11 @@ class Summary(Plugin):
                 if not cursor.fetchone():
                     cursor.execute("ALTER TABLE chat_records ADD COLUMN is_triggered INTEGER DEFAULT 0")
                     cursor.execute("UPDATE chat_records SET is_triggered = 0")
+
+                # 入库时统计的 token 数，旧记录为 NULL，读取时再统计；
+                # 格式化后的行读取时由 content 生成，不再重复存储，旧版本的 rendered 列直接删除（只修改元数据）
+                cursor.execute("ALTER TABLE chat_records ADD COLUMN IF NOT EXISTS token_count INTEGER")
+                cursor.execute("ALTER TABLE chat_records DROP COLUMN IF EXISTS rendered")
                     
             except Exception as e:
                 logger.error(f"[Summary] 初始化或修改数据库表结构失败: {e}")
@@ -247,6 +433,7 @@ class Summary(Plugin):
                             type TEXT, 
                             timestamp INTEGER, 
                             is_triggered INTEGER,
+                            token_count INTEGER,
                             PRIMARY KEY (sessionid, msgid))''')
             
             # 检查新增列是否存在
@@ -261,8 +448,213 @@ class Summary(Plugin):
             if 'is_triggered' not in columns:
                 cursor.execute("ALTER TABLE chat_records ADD COLUMN is_triggered INTEGER DEFAULT 0;")
                 cursor.execute("UPDATE chat_records SET is_triggered = 0;")
-        
-        self.conn.commit()
+
+            # 入库时统计的 token 数，旧记录为 NULL，读取时再统计
+            if 'token_count' not in columns:
+                cursor.execute("ALTER TABLE chat_records ADD COLUMN token_count INTEGER;")
+            # 格式化后的行读取时由 content 生成，不再重复存储；删除旧版本的 rendered 列（需要 SQLite 3.35+），
+            # 不支持时保留该列，新记录中为 NULL
+            if 'rendered' in columns:
+                try:
+                    cursor.execute("ALTER TABLE chat_records DROP COLUMN rendered;")
+                except sqlite3.OperationalError as e:
+                    logger.warning(f"[Summary] 无法删除 chat_records 的 rendered 列，保留该列: {e}")
+
+    def _ensure_indexes(self):
+        """
+        创建 _get_records 使用的复合索引（对已有数据库同样生效）
+
+        - idx_chat_records_session_triggered_ts：群聊查询 sessionid=? AND is_triggered=0 AND timestamp>? ORDER BY timestamp DESC
+        - idx_chat_records_session_ts：私聊查询不过滤 is_triggered，按 sessionid + timestamp 倒序扫描
+        两个索引都能让查询按索引顺序读取并在 LIMIT 处停止，不再对整个会话历史排序。
+        """
+        try:
+            start = time.time()
+            with self.db.write() as conn:
+                cursor = conn.cursor()
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_chat_records_session_triggered_ts "
+                    "ON chat_records (sessionid, is_triggered, timestamp DESC)"
+                )
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_chat_records_session_ts "
+                    "ON chat_records (sessionid, timestamp DESC)"
+                )
+            elapsed = time.time() - start
+            if elapsed > 1:
+                logger.info(f"[Summary] 已创建 chat_records 复合索引，耗时 {elapsed:.1f} 秒")
+        except Exception as e:
+            logger.error(f"[Summary] 创建 chat_records 索引失败: {e}")
+
+    def _ensure_search_index(self):
+        """
+        创建聊天记录全文索引（content 和 username）
+
+        - SQLite：FTS5 外部内容表 chat_records_fts，优先使用 trigram 分词以支持中文子串匹配，由触发器保持同步
+        - PostgreSQL：生成列 search_vector（tsvector）+ GIN 索引；pg_trgm 可用时额外建立 content 的三元组 GIN 索引，
+          用于 simple 分词无法切分的中文关键词
+        """
+        self.search_backend = None
+        try:
+            if self.use_postgres:
+                with self.db.write() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute(
+                        "ALTER TABLE chat_records ADD COLUMN IF NOT EXISTS search_vector tsvector "
+                        "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(username, '') || ' ' || coalesce(content, ''))) STORED"
+                    )
+                    cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_search ON chat_records USING GIN (search_vector)")
+                self.search_backend = "tsvector"
+                try:
+                    with self.db.write() as conn:
+                        cursor = conn.cursor()
+                        cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+                        cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_records_content_trgm ON chat_records USING GIN (content gin_trgm_ops)")
+                    self.search_backend = "tsvector+trgm"
+                except Exception as e:
+                    logger.info(f"[Summary] pg_trgm 不可用，中文关键词搜索将无法使用索引: {e}")
+                return
+
+            with self.db.write() as conn:
+                cursor = conn.cursor()
+                cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_records_fts'")
+                exists = cursor.fetchone() is not None
+                if not exists:
+                    try:
+                        cursor.execute(
+                            "CREATE VIRTUAL TABLE chat_records_fts USING fts5("
+                            "content, username, content='chat_records', content_rowid='rowid', tokenize='trigram')"
+                        )
+                    except sqlite3.OperationalError:
+                        # SQLite 3.34 以下没有 trigram 分词器
+                        cursor.execute(
+                            "CREATE VIRTUAL TABLE chat_records_fts USING fts5("
+                            "content, username, content='chat_records', content_rowid='rowid')"
+                        )
+                # INSERT OR REPLACE 删除旧行时，需要开启 recursive_triggers 才会触发删除触发器（见 SQLiteStore）
+                cursor.execute('''CREATE TRIGGER IF NOT EXISTS chat_records_fts_insert AFTER INSERT ON chat_records BEGIN
+                                    INSERT INTO chat_records_fts(rowid, content, username) VALUES (new.rowid, new.content, new.username);
+                                END''')
+                cursor.execute('''CREATE TRIGGER IF NOT EXISTS chat_records_fts_delete AFTER DELETE ON chat_records BEGIN
+                                    INSERT INTO chat_records_fts(chat_records_fts, rowid, content, username) VALUES ('delete', old.rowid, old.content, old.username);
+                                END''')
+                cursor.execute('''CREATE TRIGGER IF NOT EXISTS chat_records_fts_update AFTER UPDATE ON chat_records BEGIN
+                                    INSERT INTO chat_records_fts(chat_records_fts, rowid, content, username) VALUES ('delete', old.rowid, old.content, old.username);
+                                    INSERT INTO chat_records_fts(rowid, content, username) VALUES (new.rowid, new.content, new.username);
+                                END''')
+                if not exists:
+                    start = time.time()
+                    cursor.execute("INSERT INTO chat_records_fts(chat_records_fts) VALUES ('rebuild')")
+                    logger.info(f"[Summary] 已为历史聊天记录建立全文索引，耗时 {time.time() - start:.1f} 秒")
+                cursor.execute("SELECT sql FROM sqlite_master WHERE name = 'chat_records_fts'")
+                self.search_backend = "fts5-trigram" if "trigram" in cursor.fetchone()[0] else "fts5"
+        except Exception as e:
+            logger.error(f"[Summary] 创建全文索引失败，搜索将退化为 LIKE 扫描: {e}")
+
+    def _search_records(self, session_id, keyword, limit=20):
+        """
+        在指定会话中全文搜索聊天记录
+
+        :return: (timestamp, username, content) 列表，按时间倒序
+        """
+        with self.db.read() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                if self.search_backend == "tsvector+trgm":
+                    condition = "(search_vector @@ plainto_tsquery('simple', %s) OR content ILIKE %s)"
+                    params = (session_id, keyword, f"%{keyword}%", limit)
+                elif self.search_backend == "tsvector":
+                    condition = "search_vector @@ plainto_tsquery('simple', %s)"
+                    params = (session_id, keyword, limit)
+                else:
+                    condition = "(content ILIKE %s OR username ILIKE %s)"
+                    params = (session_id, f"%{keyword}%", f"%{keyword}%", limit)
+                cursor.execute(
+                    f"SELECT timestamp, username, content FROM chat_records WHERE sessionid=%s AND {condition} "
+                    f"ORDER BY timestamp DESC LIMIT %s",
+                    params
+                )
+            elif self.search_backend and not (self.search_backend == "fts5-trigram" and len(keyword) < 3):
+                # 关键词作为短语匹配；trigram 分词要求关键词至少 3 个字符
+                phrase = '"' + keyword.replace('"', '""') + '"'
+                cursor.execute(
+                    "SELECT r.timestamp, r.username, r.content FROM chat_records_fts f "
+                    "JOIN chat_records r ON r.rowid = f.rowid "
+                    "WHERE chat_records_fts MATCH ? AND r.sessionid = ? ORDER BY r.timestamp DESC LIMIT ?",
+                    (phrase, session_id, limit)
+                )
+            else:
+                # 过短的关键词沿 (sessionid, timestamp) 索引倒序扫描，找到 limit 条即停止
+                cursor.execute(
+                    "SELECT timestamp, username, content FROM chat_records "
+                    "WHERE sessionid=? AND (content LIKE ? OR username LIKE ?) ORDER BY timestamp DESC LIMIT ?",
+                    (session_id, f"%{keyword}%", f"%{keyword}%", limit)
+                )
+            return cursor.fetchall()
+
+    def _handle_search(self, e_context, keyword):
+        """处理搜索命令：$搜索 关键词"""
+        trigger_prefix = self.config.get('plugin_trigger_prefix', "$")
+        keyword = keyword.strip()
+        if not keyword:
+            e_context["reply"] = Reply(ReplyType.ERROR, f"请输入搜索关键词，例如：{trigger_prefix}搜索 关键词")
+            e_context.action = EventAction.BREAK_PASS
+            return
+
+        session_id = e_context['context']['msg'].from_user_id
+        self.ingest_queue.flush()
+
+        start = time.perf_counter()
+        limit = self.config.get("search_result_limit", 20)
+        # 多取一条，排除搜索命令本身
+        records = self._search_records(session_id, keyword, limit + 1)
+        records = [r for r in records if not (r[2] or "").startswith(f"{trigger_prefix}搜索")][:limit]
+        logger.info(f"[Summary] 搜索 \"{keyword}\" 命中 {len(records)} 条，耗时 {(time.perf_counter() - start) * 1000:.1f}ms")
+
+        if not records:
+            e_context["reply"] = Reply(ReplyType.TEXT, f"没有找到包含\"{keyword}\"的聊天记录")
+            e_context.action = EventAction.BREAK_PASS
+            return
+
+        lines = []
+        for timestamp, username, content in reversed(records):
+            time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+            lines.append(f"[{time_str}] {username or ''}: {content or ''}")
+        e_context["reply"] = Reply(ReplyType.TEXT, "\n".join(lines))
+        e_context.action = EventAction.BREAK_PASS
+
+    def _check_query_plan(self):
+        """
+        启动自检：用 EXPLAIN / EXPLAIN QUERY PLAN 检查 _get_records 的查询是否使用了复合索引，
+        未使用时输出警告（例如索引创建失败或被手工删除）
+        """
+        queries = {
+            "idx_chat_records_session_triggered_ts": "SELECT msgid, sessionid, username, content, type, timestamp, is_triggered, token_count FROM chat_records WHERE sessionid={ph} AND timestamp>{ph} AND is_triggered=0 ORDER BY timestamp DESC LIMIT {ph}",
+            "idx_chat_records_session_ts": "SELECT msgid, sessionid, username, content, type, timestamp, is_triggered, token_count FROM chat_records WHERE sessionid={ph} AND timestamp>{ph} ORDER BY timestamp DESC LIMIT {ph}",
+        }
+        try:
+            with self.db.read() as conn:
+                cursor = conn.cursor()
+                for index_name, query in queries.items():
+                    if self.use_postgres:
+                        cursor.execute("EXPLAIN " + query.format(ph="%s"), ("", 0, 100))
+                        plan = "\n".join(row[0] for row in cursor.fetchall())
+                        if index_name in plan:
+                            continue
+                        # 小表上 PostgreSQL 会优先选择顺序扫描，这种情况不需要告警
+                        cursor.execute("SELECT reltuples FROM pg_class WHERE relname = 'chat_records'")
+                        row = cursor.fetchone()
+                        if row and row[0] < 10000:
+                            logger.debug(f"[Summary] chat_records 数据量较小，查询计划未使用 {index_name}: {plan}")
+                            continue
+                        logger.warning(f"[Summary] 聊天记录查询未使用索引 {index_name}，总结耗时会随历史记录增长: {plan}")
+                    else:
+                        cursor.execute("EXPLAIN QUERY PLAN " + query.format(ph="?"), ("", 0, 100))
+                        plan = "\n".join(str(row[-1]) for row in cursor.fetchall())
+                        if index_name not in plan or "TEMP B-TREE" in plan:
+                            logger.warning(f"[Summary] 聊天记录查询未使用索引 {index_name}，总结耗时会随历史记录增长: {plan}")
+        except Exception as e:
+            logger.warning(f"[Summary] 查询计划自检失败: {e}")
 
     def _load_config(self):
         """从 config.json 加载配置"""
@@ -276,15 +668,15 @@ class Summary(Plugin):
             logger.error(f"[Summary] 加载配置失败: {e}")
             return {}
 
-    def _get_openai_chat_url(self):
-        """获取 OpenAI 聊天补全 API URL"""
-        return f"{self.open_ai_api_base}/chat/completions"
+    def _get_openai_chat_url(self, api_base=None):
+        """获取 OpenAI 聊天补全 API URL，默认使用 open_ai_api_base"""
+        return f"{api_base or self.open_ai_api_base}/chat/completions"
 
-    def _get_openai_headers(self):
-        """获取 OpenAI API 请求头"""
+    def _get_openai_headers(self, api_base=None, api_key=None):
+        """获取 OpenAI API 请求头，默认使用 open_ai_api_base 和 open_ai_api_key"""
         return {
-            'Authorization': f"Bearer {self.open_ai_api_key}",
-            'Host': urlparse(self.open_ai_api_base).netloc,
+            'Authorization': f"Bearer {api_key or self.open_ai_api_key}",
+            'Host': urlparse(api_base or self.open_ai_api_base).netloc,
             'Content-Type': 'application/json'
         }
     
@@ -305,13 +697,18 @@ class Summary(Plugin):
             'max_tokens': self.summary_max_tokens #修改变量名
         }
 
-    def _chat_completion(self, content, custom_prompt=None, prompt_type="summary"):
+    def _chat_completion(self, content, custom_prompt=None, prompt_type="summary", streamer=None):
+        """同步调用 OpenAI 聊天补全 API，参数与返回值同 _chat_completion_async"""
+        return self.llm_engine.run(self._chat_completion_async(content, custom_prompt, prompt_type, streamer))
+
+    async def _chat_completion_async(self, content, custom_prompt=None, prompt_type="summary", streamer=None):
         """
         调用 OpenAI 聊天补全 API
         
         :param content: 需要总结的聊天内容
         :param custom_prompt: 可选的自定义 prompt，用于替换默认 prompt
-        :param prompt_type:  定义使用哪一个类型的prompt，可选值 summary，image
+        :param prompt_type:  定义使用哪一个类型的prompt，可选值 summary，image，merge，incremental
+        :param streamer: 可选的 TopicStreamer，传入时以流式（SSE）请求，每输出完一个主题就发送
         :return: 总结后的文本
         """
         try:
@@ -320,6 +717,10 @@ class Summary(Plugin):
               prompt_to_use = self.default_summary_prompt
             elif prompt_type == "image":
                 prompt_to_use = self.default_image_prompt
+            elif prompt_type == "merge":
+                prompt_to_use = self.default_merge_prompt
+            elif prompt_type == "incremental":
+                prompt_to_use = self.default_summary_prompt + self.default_incremental_prompt
             else:
                 prompt_to_use = self.default_summary_prompt #默认选择 summary 类型
             # 使用 custom_prompt，如果 custom_prompt 为空，则替换为 "无"
@@ -340,16 +741,49 @@ class Summary(Plugin):
                 "max_tokens": self.summary_max_tokens #修改变量名
             }
             
-            # 获取 OpenAI API URL 和请求头
-            url = self._get_openai_chat_url()
-            headers = self._get_openai_headers()
-            
+            # 按提示词、聊天内容和最大输出估算 token
+            estimated_tokens = self._estimate_tokens(prompt_to_use + content) + self.summary_max_tokens
+            if streamer is not None:
+                payload["stream"] = True
+
+            charged = set()
+
+            async def send(endpoint, claim):
+                """向一个端点发送请求；多个端点对冲时由 completion_router 选出胜者"""
+                # 对冲和故障转移的请求只占用目标端点 Key 的配额，同一个 Key 在一次总结中只扣一次
+                if endpoint.api_key not in charged:
+                    charged.add(endpoint.api_key)
+                    await self.llm_scheduler.acquire_async(endpoint.api_key, estimated_tokens, PRIORITY_INTERACTIVE)
+                url = self._get_openai_chat_url(endpoint.api_base)
+                headers = self._get_openai_headers(endpoint.api_base, endpoint.api_key)
+                if streamer is None:
+                    return await self.llm_engine.post(url, headers=headers, json=dict(payload, model=endpoint.model))
+
+                async def on_line(line):
+                    if not claim():
+                        return
+                    delta = parse_sse_delta(line)
+                    if delta:
+                        for block in streamer.feed(delta):
+                            await self.llm_engine.run_blocking(streamer.emit, block)
+
+                return await self.llm_engine.post(url, headers=headers, json=dict(payload, model=endpoint.model), on_line=on_line)
+
             # 发送 API 请求
-            response = requests.post(url, headers=headers, json=payload)
+            endpoint, response = await self.completion_router.post(send, hedge=streamer is not None)
+
+            if streamer is not None:
+                if response.status_code == 200:
+                    return streamer.text.strip()
+                logger.error(f"[Summary] OpenAI API 错误: {response.text}")
+                return f"总结失败：{response.text}"
             
             # 检查并处理响应
             if response.status_code == 200:
                 result = response.json()
+                used_tokens = (result.get('usage') or {}).get('total_tokens')
+                if used_tokens:
+                    self.llm_scheduler.refund(endpoint.api_key, estimated_tokens - used_tokens)
                 summary = result['choices'][0]['message']['content'].strip()
                 return summary
             else:
@@ -360,9 +794,15 @@ class Summary(Plugin):
             logger.error(f"[Summary] 总结生成失败: {e}")
             return f"总结失败：{str(e)}"
     
-    def _multimodal_completion(self, api_key, image_path, text_prompt, model="GLM-4V-Flash", detail="low"):
+    def _multimodal_completion(self, api_key, encoded_image, text_prompt, model="GLM-4V-Flash", detail="low"):
+        """同步调用多模态 API，参数与返回值同 _multimodal_completion_async"""
+        return self.llm_engine.run(self._multimodal_completion_async(api_key, encoded_image, text_prompt, model, detail))
+
+    async def _multimodal_completion_async(self, api_key, encoded_image, text_prompt, model="GLM-4V-Flash", detail="low"):
         """
         调用多模态 API 进行图片理解和文本生成。
+
+        :param encoded_image: encode_image 生成的 JPEG base64 字符串；为列表时在一个请求中发送多张图片，每张图片前标注【序号】
         """
 
         api_url = f"{self.multimodal_llm_api_base}/chat/completions" # 从配置项读取并拼接 URL
@@ -372,12 +812,26 @@ class Summary(Plugin):
             "Host": urlparse(self.multimodal_llm_api_base).netloc # 从配置项读取，并解析host
         }
 
-        try:
-            # 1. 读取图片并进行 base64 编码
-            with open(image_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            image_url_data = f"data:image/jpeg;base64,{encoded_string}"
+        batched = isinstance(encoded_image, (list, tuple))
+        encoded_images = encoded_image if batched else [encoded_image]
 
+        # 识图是后台任务，配额不足时由调度器延后或丢弃（抛出 RateLimitExceeded）；每张图片按 1000 token 估算
+        await self.llm_scheduler.acquire_async(api_key, self._estimate_tokens(text_prompt) + 1000 * len(encoded_images), PRIORITY_BACKGROUND)
+
+        try:
+            # 1. 使用预处理阶段已经缩放并编码好的图片
+            content = []
+            for index, image in enumerate(encoded_images, 1):
+                if batched:
+                    content.append({"type": "text", "text": f"【{index}】"})
+                content.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{image}",
+                        "detail": detail
+                    }
+                })
+            content.append({"type": "text", "text": text_prompt})
 
             # 2. 构建 JSON Payload
             payload = {
@@ -385,26 +839,16 @@ class Summary(Plugin):
                 "messages": [
                     {
                         "role": "user",
-                        "content": [
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": image_url_data,
-                                    "detail": detail
-                                }
-                            },
-                            {
-                                "type": "text",
-                                "text": text_prompt
-                            }
-                        ]
+                        "content": content
                     }
                 ]
             }
 
             # 3. 发送请求并处理响应
-            response = requests.post(api_url, headers=headers, json=payload)
-            response.raise_for_status()  # 检查 HTTP 错误
+            response = await self.llm_engine.post(api_url, headers=headers, json=payload)
+            if response.status_code >= 400:  # 检查 HTTP 错误
+                print(f"请求 API 发生错误: {response.status_code} {response.text}")
+                return None
 
             json_response = response.json()
 
@@ -416,68 +860,107 @@ class Summary(Plugin):
                 return None
 
 
-        except requests.exceptions.RequestException as e:
+        except aiohttp.ClientError as e:
             print(f"请求 API 发生错误: {e}")
             return None
         except json.JSONDecodeError as e:
             print(f"JSON 解析错误: {e}")
             return None
-        except FileNotFoundError as e:
-            print(f"图片文件找不到: {e}")
-            return None
         except Exception as e:
             print(f"发生未知错误: {e}")
             return None
 
+    async def _describe_image_async(self, encoded_image):
+        """使用默认识图提示词描述一张图片"""
+        return await self._multimodal_completion_async(
+            self.multimodal_llm_api_key, encoded_image, self.default_image_prompt, model=self.multimodal_llm_model
+        )
 
-    def _resize_and_encode_image(self, image_path):
-        """将图片调整大小并编码为 base64"""
-        try:
-            img = Image.open(image_path)
-            
-            # 将图片转换为 RGB 模式，去除 alpha 通道
-            if img.mode == 'RGBA':
-                img = img.convert('RGB')
-
-            max_size = (2048, 2048)
-            img.thumbnail(max_size)
-
-            # 检查图片大小，如果超过 1M 就尝试降低质量
-            if os.path.getsize(image_path) > 1 * 1024 * 1024:
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG", quality=80)  # 降低质量
-                base64_str = base64.b64encode(buffer.getvalue()).decode('utf-8')
-                if len(base64_str) * 3 / 4 / 1024 / 1024 > 1: #评估base64后的图片大小是否超过1M，是的话直接放弃
-                   return None
-                return base64_str
-            else:
-                buffer = BytesIO()
-                img.save(buffer, format="JPEG")
-                return base64.b64encode(buffer.getvalue()).decode('utf-8')
-        except Exception as e:
-            logger.error(f"[Summary] 图片处理失败: {e}")
-            return None
+    async def _describe_images_async(self, encoded_images):
+        """在一个请求中描述多张图片，返回按顺序排列的描述；回复无法按序号拆分时返回 None"""
+        prompt = BATCH_CAPTION_PROMPT.format(count=len(encoded_images), prompt=self.default_image_prompt)
+        text = await self._multimodal_completion_async(
+            self.multimodal_llm_api_key, list(encoded_images), prompt, model=self.multimodal_llm_model
+        )
+        return split_batch_captions(text, len(encoded_images))
 
     def _insert_record(self, session_id, msg_id, username, content, msg_type, timestamp, is_triggered=0, session_name=None, user_id=None):
-        """将记录插入到数据库"""
-        cursor = self.conn.cursor()
+        """将记录放入写后队列，由写线程批量插入数据库；同时统计该记录格式化后的行的 token 数"""
         logger.debug("[Summary] 插入记录: {} {} {} {} {} {} {} {} {}" .format(session_id, msg_id, session_name, user_id, username, content, msg_type, timestamp, is_triggered))
-        
-        if self.use_postgres:
-            cursor.execute(
-                "INSERT INTO chat_records VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (sessionid, msgid) DO UPDATE SET sessionname = %s, userid = %s, username = %s, content = %s, type = %s, timestamp = %s, is_triggered = %s", 
-                (msg_id, session_id, session_name, user_id, username, content, msg_type, timestamp, is_triggered, 
-                 session_name, user_id, username, content, msg_type, timestamp, is_triggered)
+        token_count = self.token_counter.count(self._render_line(username, content, msg_type, timestamp, is_triggered))
+        self.ingest_queue.put((msg_id, session_id, session_name, user_id, username, content, msg_type, timestamp, is_triggered, token_count))
+
+    def _flush_records(self, rows):
+        """
+        在一个事务中批量写入记录（由写后队列的写线程调用）
+
+        :param rows: 记录元组列表，字段顺序见 CHAT_RECORD_COLUMNS
+        """
+        # 同一批次中相同 (sessionid, msgid) 的记录只保留最后一条，
+        # 例如图片描述会覆盖原始的图片记录；PostgreSQL 的多行 upsert 也不允许同一行出现两次
+        deduped = {}
+        for row in rows:
+            deduped[(row[1], row[0])] = row
+        rows = list(deduped.values())
+        session_deltas = self.session_meta.take_dirty()
+
+        try:
+            with self.db.write() as conn:
+                cursor = conn.cursor()
+                self._write_chat_records(cursor, rows)
+                self.session_meta.write_deltas(cursor, session_deltas)
+        except Exception:
+            self.session_meta.restore_dirty(session_deltas)
+            raise
+
+    def _write_chat_records(self, cursor, rows):
+        """在调用方的事务中写入 chat_records"""
+        if self.use_postgres and len(rows) >= self.postgres_copy_min_batch:
+            # 大批量时用 COPY 写入临时表，再用一条 upsert 合并
+            copy_upsert_chat_records(cursor, rows)
+        elif self.use_postgres:
+            psycopg2.extras.execute_values(
+                cursor,
+                f"INSERT INTO chat_records ({', '.join(CHAT_RECORD_COLUMNS)}) VALUES %s ON CONFLICT (sessionid, msgid) DO UPDATE SET "
+                "sessionname = EXCLUDED.sessionname, userid = EXCLUDED.userid, username = EXCLUDED.username, "
+                "content = EXCLUDED.content, type = EXCLUDED.type, timestamp = EXCLUDED.timestamp, "
+                "is_triggered = EXCLUDED.is_triggered, token_count = EXCLUDED.token_count",
+                rows,
+                page_size=len(rows)
             )
         else:
-            cursor.execute(
-                "INSERT OR REPLACE INTO chat_records VALUES (?,?,?,?,?,?,?,?,?)", 
-                (msg_id, session_id, session_name, user_id, username, content, msg_type, timestamp, is_triggered)
+            cursor.executemany(
+                f"INSERT OR REPLACE INTO chat_records ({', '.join(CHAT_RECORD_COLUMNS)}) VALUES ({', '.join('?' * len(CHAT_RECORD_COLUMNS))})",
+                rows
             )
-        
-        self.conn.commit()
+
+    def _shutdown(self):
+        """进程退出时写出缓冲区中的记录并关闭数据库连接"""
+        self.caption_jobs.close()
+        self.ingest_queue.stop()
+        self.db.close()
+        self.llm_engine.close()
+        self.llm_client.close()
+
+    def get_metrics(self):
+        """返回插件内部各组件的运行指标"""
+        return {
+            "ingest": self.ingest_queue.stats(),
+            "database": self.db.stats(),
+            "session_meta": self.session_meta.stats(),
+            "caption_cache": self.caption_cache.stats(),
+            "caption_batcher": self.caption_batcher.stats(),
+            "caption_jobs": self.caption_jobs.stats(),
+            "summary_cache": self.summary_cache.stats(),
+            "summary_flight": self.summary_flight.stats(),
+            "llm": self.llm_client.stats(),
+            "llm_engine": self.llm_engine.stats(),
+            "llm_scheduler": self.llm_scheduler.stats(),
+            "llm_endpoints": self.completion_router.stats(),
+            "token_counter": self.token_counter.stats(),
+        }
     
-    def _get_records(self, session_id, start_timestamp=0, limit=9999, is_group=None):
+    def _get_records(self, session_id, start_timestamp=0, limit=9999, is_group=None, max_tokens=None):
         """
         从数据库获取记录
         
@@ -489,52 +972,69 @@ class Summary(Plugin):
         :param start_timestamp: 开始时间戳，只返回该时间之后的记录
         :param limit: 限制返回的记录数量
         :param is_group: 是否为群聊，如果为None会自动检测
-        :return: 记录列表，按时间戳降序排列
+        :param max_tokens: 可选的 token 预算：从最新的记录开始分批读取，累计 token 数超过预算后不再读取
+        :return: 记录列表，按时间戳降序排列，每条记录为 (msgid, sessionid, username, content, type, timestamp, is_triggered, token_count)，
+                 token_count 为入库时统计的 token 数，旧记录为 None
         """
-        cursor = self.conn.cursor()
-        
-        # 检查会话是否为群聊（如果未指定）
-        if is_group is None:
-            if self.use_postgres:
-                cursor.execute(
-                    "SELECT DISTINCT sessionname FROM chat_records WHERE sessionid=%s LIMIT 1", 
-                    (session_id,)
-                )
-            else:
-                cursor.execute(
-                    "SELECT DISTINCT sessionname FROM chat_records WHERE sessionid=? LIMIT 1", 
-                    (session_id,)
-                )
-            
-            result = cursor.fetchone()
-            is_group = bool(result and result[0])  # 如果sessionname存在且非空，则视为群聊
+        with self.db.read() as conn:
+            # 检查会话是否为群聊（如果未指定），从会话元数据缓存读取，不扫描 chat_records；
+            # 缓存未命中时使用已持有的连接查询，不再从连接池占用第二个连接
+            if is_group is None:
+                meta = self.session_meta.get(session_id, conn.cursor())
+                is_group = bool(meta and meta.is_group)
+            if max_tokens is None:
+                return self._query_records(conn.cursor(), session_id, start_timestamp, limit, is_group)
+            # PostgreSQL 使用服务端游标，只把读到的批次传回客户端；SQLite 的游标本身就是逐步执行的
+            cursor = conn.cursor(name="summary_records") if self.use_postgres else conn.cursor()
+            try:
+                return self._query_records(cursor, session_id, start_timestamp, limit, is_group, max_tokens)
+            finally:
+                cursor.close()
+
+    def _query_records(self, cursor, session_id, start_timestamp, limit, is_group, max_tokens=None):
+        """执行 _get_records 的查询"""
         
         # 构建查询语句 - 对群聊过滤掉is_triggered=1的记录，私聊不过滤
         if is_group:
             if self.use_postgres:
                 cursor.execute(
-                    "SELECT * FROM chat_records WHERE sessionid=%s AND timestamp>%s AND is_triggered=0 ORDER BY timestamp DESC LIMIT %s", 
+                    "SELECT msgid, sessionid, username, content, type, timestamp, is_triggered, token_count FROM chat_records WHERE sessionid=%s AND timestamp>%s AND is_triggered=0 ORDER BY timestamp DESC LIMIT %s", 
                     (session_id, start_timestamp, limit)
                 )
             else:
                 cursor.execute(
-                    "SELECT * FROM chat_records WHERE sessionid=? AND timestamp>? AND is_triggered=0 ORDER BY timestamp DESC LIMIT ?", 
+                    "SELECT msgid, sessionid, username, content, type, timestamp, is_triggered, token_count FROM chat_records WHERE sessionid=? AND timestamp>? AND is_triggered=0 ORDER BY timestamp DESC LIMIT ?", 
                     (session_id, start_timestamp, limit)
                 )
         else:
             # 私聊不过滤is_triggered
             if self.use_postgres:
                 cursor.execute(
-                    "SELECT * FROM chat_records WHERE sessionid=%s AND timestamp>%s ORDER BY timestamp DESC LIMIT %s", 
+                    "SELECT msgid, sessionid, username, content, type, timestamp, is_triggered, token_count FROM chat_records WHERE sessionid=%s AND timestamp>%s ORDER BY timestamp DESC LIMIT %s", 
                     (session_id, start_timestamp, limit)
                 )
             else:
                 cursor.execute(
-                    "SELECT * FROM chat_records WHERE sessionid=? AND timestamp>? ORDER BY timestamp DESC LIMIT ?", 
+                    "SELECT msgid, sessionid, username, content, type, timestamp, is_triggered, token_count FROM chat_records WHERE sessionid=? AND timestamp>? ORDER BY timestamp DESC LIMIT ?", 
                     (session_id, start_timestamp, limit)
                 )
         
-        return cursor.fetchall()
+        if max_tokens is None:
+            return cursor.fetchall()
+
+        records = []
+        total_tokens = 0
+        while total_tokens <= max_tokens:
+            batch = cursor.fetchmany(self.record_fetch_batch_size)
+            if not batch:
+                break
+            for record in batch:
+                records.append(record)
+                total_tokens += self._record_tokens(record, self._format_record(record))
+                if total_tokens > max_tokens:
+                    logger.info(f"[Summary] 已读取 {len(records)} 条记录，达到 {max_tokens} token 的预算")
+                    break
+        return records
 
     def on_receive_message(self, e_context: EventContext):
         """处理接收到的消息"""
@@ -582,24 +1082,15 @@ class Summary(Plugin):
         msg_type = str(context.type)
         processed_content = content
         
-        # 如果是SHARING类型，或者内容包含XML特征，尝试处理
-        if context.type == ContextType.SHARING or (
-            "<?xml" in content and "<msg>" in content and "<appmsg" in content):
-            
-            # 检查是否是音乐分享
-            is_music_share = False
-            if "<?xml" in content and "<type>3</type>" in content and "<title>" in content:
-                title_match = re.search(r'<title>\[(.*?)\](.*?)</title>', content)
-                if title_match:
-                    is_music_share = True
-                    processed_content = self._process_message_content(content, context.type)
-                    msg_type = "EXPLAIN"  # 修改为EXPLAIN类型
-                    logger.debug(f"[Summary] 检测到音乐分享: {processed_content}")
-            
-            # 如果不是音乐分享，检查是否是不支持展示的内容（兼容中英文版本）
-            if not is_music_share and "<title>" in content and (
-                "不支持展示该内容" in content or 
-                "Your current Weixin version does not support this content" in content):
+        # 如果是SHARING类型，或者内容包含 XML 声明的 appmsg 卡片，尝试处理
+        parsed = classify_message(content)
+        if context.type == ContextType.SHARING or (parsed.xml_decl and parsed.kind in (MSG_MUSIC, MSG_VIDEO, MSG_SHARE)):
+            if parsed.kind == MSG_MUSIC:
+                processed_content = self._process_message_content(content, context.type)
+                msg_type = "EXPLAIN"  # 修改为EXPLAIN类型
+                logger.debug(f"[Summary] 检测到音乐分享: {processed_content}")
+            elif parsed.kind == MSG_VIDEO and parsed.is_unsupported():
+                # 不支持展示的内容（视频号等）
                 processed_content = self._process_wechat_video_content(content)
                 if processed_content.startswith("[多媒体描述]"):
                     msg_type = "EXPLAIN"
@@ -610,6 +1101,7 @@ class Summary(Plugin):
             if processed_content.startswith("[多媒体描述]") or processed_content.startswith("[音乐分享]"):
                 msg_type = "EXPLAIN"
             
+        self.session_meta.record_message(session_id, session_name, context.get("isgroup", False), cmsg.create_time)
         self._insert_record(
             session_id, 
             cmsg.msg_id, 
@@ -638,53 +1130,15 @@ class Summary(Plugin):
         :return: 处理后的描述文本，格式为 [多媒体描述]描述内容
         """
         try:
-            logger.debug(f"[Summary] 尝试解析微信视频内容，内容特征：XML长度={len(content)}，包含appmsg={('<appmsg' in content)}")
-            
-            # 检查是否包含特定微信视频的XML标记
-            if "<?xml" in content and "<msg>" in content and "<appmsg" in content:
-                # 检查是否有"不支持展示该内容"的标记（兼容中英文版本的提示文本）
-                title_match = re.search(r'<title>(.*?)</title>', content)
-                if title_match and ("不支持展示该内容" in title_match.group(1) or 
-                                 "Your current Weixin version does not support this content" in title_match.group(1)):
-                    logger.debug(f"[Summary] 找到不支持展示内容标记，标题：{title_match.group(1)}")
-                    
-                    # 尝试多种方式提取描述信息
-                    desc = None
-                    
-                    # 1. 尝试从finderFeed/desc提取
-                    finder_desc_match = re.search(r'<finderFeed>.*?<desc>(.*?)</desc>', content, re.DOTALL)
-                    if finder_desc_match and finder_desc_match.group(1).strip():
-                        desc = finder_desc_match.group(1).strip()
-                        logger.debug(f"[Summary] 从finderFeed/desc提取到描述：{desc}")
-                    
-                    # 2. 尝试从根级别的desc提取
-                    if not desc:
-                        root_desc_match = re.search(r'<desc>(.*?)</desc>', content)
-                        if root_desc_match and root_desc_match.group(1).strip():
-                            desc = root_desc_match.group(1).strip()
-                            logger.debug(f"[Summary] 从根级别desc提取到描述：{desc}")
-                    
-                    # 3. 尝试从nickname提取
-                    if not desc:
-                        nickname_match = re.search(r'<nickname>(.*?)</nickname>', content)
-                        if nickname_match and nickname_match.group(1).strip():
-                            desc = f"来自{nickname_match.group(1).strip()}的视频"
-                            logger.debug(f"[Summary] 从nickname提取到描述：{desc}")
-                    
-                    # 4. 尝试从bizNickname提取
-                    if not desc:
-                        biz_nickname_match = re.search(r'<bizNickname>(.*?)</bizNickname>', content)
-                        if biz_nickname_match and biz_nickname_match.group(1).strip():
-                            desc = f"来自{biz_nickname_match.group(1).strip()}的视频"
-                            logger.debug(f"[Summary] 从bizNickname提取到描述：{desc}")
-                    
-                    # 如果找到描述，返回格式化内容
-                    if desc:
-                        return f"[多媒体描述]{desc}"
-                    else:
-                        logger.debug("[Summary] 未能提取到任何有效描述")
-                        return "[多媒体描述]未知内容的视频"
-            
+            parsed = classify_message(content)
+            if parsed.kind == MSG_VIDEO and parsed.is_unsupported():
+                desc = parsed.video_desc
+                if desc:
+                    logger.debug(f"[Summary] 提取到视频描述：{desc}")
+                    return f"[多媒体描述]{desc}"
+                logger.debug("[Summary] 未能提取到任何有效描述")
+                return "[多媒体描述]未知内容的视频"
+
             # 如果不满足条件或者提取失败，返回原内容
             logger.debug("[Summary] 内容不符合微信视频格式，返回原内容")
             return content
@@ -700,36 +1154,15 @@ class Summary(Plugin):
         [引用]{JSON数据体不换行}
         JSON结构：{"reply":"回复内容","quote_type":"text|image|share|video|music","quoted_person":"引用人名字","content":内容对象}
         """
-        # 检查是否是微信视频或特殊XML消息（处理需要在引用检查前进行）
-        # 对任何类型的消息，只要内容包含XML结构且含有特定标记，就进行处理
-        if "<?xml" in content and "<msg>" in content and "<appmsg" in content:
-            # 检查是否是音乐分享
-            type_match = re.search(r'<type>(\d+)</type>', content)
-            title_match = re.search(r'<title>\[(.*?)\](.*?)</title>', content)
-            
-            if type_match and title_match and type_match.group(1) == "3":
-                # 音乐分享，提取信息
-                music_app = title_match.group(1).strip()
-                song_title = title_match.group(2).strip()
-                
-                artist = ""
-                des_match = re.search(r'<des>(.*?)</des>', content)
-                if des_match:
-                    artist = des_match.group(1).strip()
-                
-                music_info = f"[音乐分享] {song_title}" + (f" - {artist}" if artist else "") + f" ({music_app})"
-                
-                return music_info
-            
-            # 检查是否是不支持展示的内容
-            title_match = re.search(r'<title>(.*?)</title>', content)
-            if title_match and "不支持展示该内容" in title_match.group(1):
-                return self._process_wechat_video_content(content)
-        
-        # 检查是否是引用消息
-        quote_match = re.search(r'「(.*?):[\s\S]*?」[\s\S]*?----------([\s\S]*)', content)
-        
-        if not quote_match:
+        parsed = classify_message(content)
+        if parsed.kind == MSG_MUSIC:
+            # 音乐分享，艺术家在 des 中
+            artist = parsed.des or ""
+            return f"[音乐分享] {parsed.music_title}" + (f" - {artist}" if artist else "") + f" ({parsed.music_app})"
+        if parsed.kind == MSG_VIDEO and parsed.is_unsupported(("不支持展示该内容",)):
+            return self._process_wechat_video_content(content)
+
+        if not parsed.is_quote:
             # 如果不是引用消息，处理普通消息
             if content_type == ContextType.IMAGE:
                 return "[图片]"
@@ -738,14 +1171,10 @@ class Summary(Plugin):
             else:
                 return content
         
-        # 提取被引用人的名字
-        quoted_person = quote_match.group(1).strip()
-        # 提取回复内容（分隔符后的部分）
-        reply_content = quote_match.group(2).strip()
-        
-        # 提取引用的内容（在「」内的部分）
-        quoted_content_match = re.search(r'「.*?:([\s\S]*?)」', content)
-        quoted_content = quoted_content_match.group(1).strip() if quoted_content_match else ""
+        # 被引用人的名字、回复内容（分隔符后的部分）和引用的内容（在「」内的部分）
+        quoted_person = parsed.quoted_person
+        reply_content = parsed.reply
+        quoted_content = parsed.quoted_content
         
         # 处理引用内容，确定引用类型和内容
         quote_info = self._process_quoted_content(quoted_content)
@@ -770,110 +1199,81 @@ class Summary(Plugin):
         
         返回格式：{"type": "text|image|share|video|music", "content": 内容对象}
         """
-        # 首先检查是否是微信视频消息
-        if "<?xml" in content and "<msg>" in content and "<appmsg" in content:
-            # 检查是否是音乐分享
-            type_match = re.search(r'<type>(\d+)</type>', content)
-            title_match = re.search(r'<title>\[(.*?)\](.*?)</title>', content)
-            
-            # 音乐类型通常是type=3，同时标题会有[音乐应用名称]格式
-            if type_match and title_match and type_match.group(1) == "3":
-                logger.debug("[Summary] 检测到音乐分享")
-                
-                # 提取音乐信息
-                music_app = title_match.group(1).strip()
-                song_title = title_match.group(2).strip()
-                
-                # 提取艺术家信息
-                artist = ""
-                des_match = re.search(r'<des>(.*?)</des>', content)
-                if des_match:
-                    artist = des_match.group(1).strip()
-                
-                # 创建音乐内容对象
-                music_content = {
-                    "app": music_app,
-                    "title": song_title,
-                    "artist": artist,
-                    "description": f"{song_title}" + (f" - {artist}" if artist else "") + f" ({music_app})"
-                }
-                
-                return {
-                    "type": "music", 
-                    "content": music_content
-                }
-            
-            # 检查是否有"不支持展示该内容"的标记（兼容中英文版本）
-            title_match = re.search(r'<title>(.*?)</title>', content)
-            if title_match and ("不支持展示该内容" in title_match.group(1) or 
-                             "not support this content" in title_match.group(1)):
-                # 尝试多种方式提取描述信息
-                desc = None
-                
-                # 尝试从finderFeed/desc提取
-                finder_desc_match = re.search(r'<finderFeed>.*?<desc>(.*?)</desc>', content, re.DOTALL)
-                if finder_desc_match and finder_desc_match.group(1).strip():
-                    desc = finder_desc_match.group(1).strip()
-                
-                # 尝试从根级别的desc提取
-                if not desc:
-                    root_desc_match = re.search(r'<desc>(.*?)</desc>', content)
-                    if root_desc_match and root_desc_match.group(1).strip():
-                        desc = root_desc_match.group(1).strip()
-                
-                # 尝试从nickname提取
-                if not desc:
-                    nickname_match = re.search(r'<nickname>(.*?)</nickname>', content)
-                    if nickname_match and nickname_match.group(1).strip():
-                        desc = f"来自{nickname_match.group(1).strip()}的视频"
-                
-                # 尝试从bizNickname提取
-                if not desc:
-                    biz_nickname_match = re.search(r'<bizNickname>(.*?)</bizNickname>', content)
-                    if biz_nickname_match and biz_nickname_match.group(1).strip():
-                        desc = f"来自{biz_nickname_match.group(1).strip()}的视频"
-                
-                return {"type": "video", "content": {"desc": desc or "未知内容的视频"}}
-        
-        # 检查是否是分享卡片（包含appmsg标签）
-        if "<msg>" in content and "<appmsg" in content:
-            # 尝试提取标题
-            title_match = re.search(r'<title>(.*?)</title>', content)
-            title = title_match.group(1).strip() if title_match else "未知标题"
-            
-            # 尝试提取URL
-            url_match = re.search(r'<url>(.*?)</url>', content)
-            url = url_match.group(1).strip() if url_match else ""
-            
-            # 构建分享卡片内容
-            share_content = {"title": title}
-            if url:
-                share_content["url"] = url
-            
+        parsed = classify_message(content)
+        if parsed.kind == MSG_MUSIC:
+            logger.debug("[Summary] 检测到音乐分享")
+            music_app = parsed.music_app
+            song_title = parsed.music_title
+            artist = parsed.des or ""
+            music_content = {
+                "app": music_app,
+                "title": song_title,
+                "artist": artist,
+                "description": f"{song_title}" + (f" - {artist}" if artist else "") + f" ({music_app})"
+            }
+            return {"type": "music", "content": music_content}
+
+        if parsed.kind == MSG_VIDEO:
+            return {"type": "video", "content": {"desc": parsed.video_desc or "未知内容的视频"}}
+
+        if parsed.kind == MSG_SHARE:
+            # 分享卡片：标题和链接
+            share_content = {"title": parsed.title or "未知标题"}
+            if parsed.url:
+                share_content["url"] = parsed.url
             return {"type": "share", "content": share_content}
-        
-        # 然后检查是否是图片（包含XML标记和img标签）
-        elif "<msg>" in content and ("<img" in content or "cdnthumburl" in content):
+
+        if parsed.kind == MSG_IMAGE:
             return {"type": "image", "content": None}
         
         # 其他内容（普通文字）
         return {"type": "text", "content": content}
 
     def _process_image_async(self, session_id, msg_id, username, image_path, create_time, session_name=None, user_id=None):
-        """使用线程池异步处理图片消息"""
-        future = self.executor.submit(self._process_image, session_id, msg_id, username, image_path, create_time, session_name, user_id)
-        future.add_done_callback(self._handle_image_result)
+        """把图片消息加入识图任务队列，排队任务已满时跳过"""
+        job = CaptionJob(session_id, msg_id, session_name, user_id, username, image_path, create_time)
+        if not self.caption_jobs.enqueue(job):
+            logger.warning(f"[Summary] 识图任务排队已满（{self.caption_jobs.max_pending}），跳过图片 {msg_id}")
 
-    def _process_image(self, session_id, msg_id, username, image_path, create_time, session_name=None, user_id=None):
-        """处理图片消息，调用多模态LLM API"""
+    async def _run_caption_job(self, job):
+        """执行一个识图任务：图片无法处理时放弃，识图失败时由队列退避重试"""
+        result = await self._process_image(
+            job.sessionid, job.msgid, job.username, job.image_path, job.create_time, job.sessionname, job.userid
+        )
+        if result is True:
+            logger.info("[Summary] 异步图片处理成功")
+            return JOB_DONE
+        if isinstance(result, str) and result.startswith("图片处理失败"):
+            return JOB_FAILED, result
+        logger.error(f"[Summary] 异步图片处理失败：{result}")
+        return JOB_RETRY, result
+
+    async def _process_image(self, session_id, msg_id, username, image_path, create_time, session_name=None, user_id=None):
+        """处理图片消息，调用多模态LLM API；图片解码在线程池中执行"""
         try:
-            base64_image = self._resize_and_encode_image(image_path)
+            # 只解码一次，缩放后的图片既用于计算感知哈希，也直接编码后用于请求
+            image = await self.llm_engine.run_blocking(load_image, image_path, self.multimodal_image_max_side)
+            if image is None:
+                    error_msg = "图片处理失败：无法解码图片"
+                    logger.error(f"[Summary] {error_msg}")
+                    return error_msg #返回错误信息
+
+            image_hash = None
+            if self.image_caption_cache_enabled:
+                image_hash, caption = await self.llm_engine.run_blocking(self.caption_cache.match, image)
+                if caption is not None:
+                    logger.debug(f"[Summary] 图片描述缓存命中: {image_hash[0]:016x}")
+                    self._insert_record(session_id, msg_id, username, f"[图片描述]{caption}", "EXPLAIN", create_time, 0, session_name, user_id)
+                    return True
+
+            base64_image = await self.llm_engine.run_blocking(encode_image, image, self.multimodal_image_max_bytes)
             if not base64_image:
                     error_msg = "图片处理失败：无法处理或图片太大"
                     logger.error(f"[Summary] {error_msg}")
                     return error_msg #返回错误信息
 
-            text_content = self._multimodal_completion(self.multimodal_llm_api_key, image_path, self.default_image_prompt, model=self.multimodal_llm_model)
+            # 同一会话短时间内的多张图片可能合并为一个请求
+            text_content = await self.caption_batcher.caption(session_id, base64_image)
 
             if text_content is None:
                     error_msg = "识图失败：多模态LLM API返回为空"
@@ -886,75 +1286,393 @@ class Summary(Plugin):
             else:
                     # 将识别出的文本内容保存到数据库
                     self._insert_record(session_id, msg_id, username, f"[图片描述]{text_content}", "EXPLAIN", create_time, 0, session_name, user_id) # 这里默认识别内容没有触发
+                    if image_hash is not None:
+                        await self.llm_engine.run_blocking(self.caption_cache.store, image_hash, text_content)
                     return True # 返回 True 表示成功
+        except RateLimitExceeded as e:
+            error_msg = f"识图失败：已跳过，{e}"
+            logger.warning(f"[Summary] {error_msg}")
+            return error_msg
         except Exception as e:
             error_msg = f"识图失败：未知错误 {str(e)}"
             logger.error(f"[Summary] {error_msg}")
             return error_msg #返回错误信息
 
-    def _handle_image_result(self, future):
-        try:
-            result = future.result()
-            if result is None:  # 检查 result 是否为 None
-                logger.error("[Summary] 异步图片处理结果为空")
-                print("[Summary] 异步图片处理结果为空")  # 添加打印到控制台的逻辑
-                return # 处理返回None的情况
-            elif isinstance(result, str) and (result.startswith("识图失败") or result.startswith("图片处理失败")):  # 确保返回的是字符串
-                logger.error(f"[Summary] 异步图片处理失败：{result}")
-                print(f"[Summary] 异步图片处理失败：{result}")  # 添加打印到控制台的逻辑
-            elif result is True:
-                logger.info("[Summary] 异步图片处理成功")
-                print("[Summary] 异步图片处理成功")
-        except Exception as e:
-            logger.error(f"[Summary] 异步处理结果错误：{e}")
-            print(f"[Summary] 异步处理结果错误：{e}")  # 添加打印到控制台的逻辑
+    def _format_record(self, record):
+        """将一条记录格式化为聊天记录中的一行"""
+        return self._render_line(record[2], record[3], record[4], record[5], record[6])
+
+    def _render_line(self, username, content, msg_type, timestamp, is_triggered):
+        """生成一条消息在聊天记录中的一行"""
+        username = username or ""  # 处理空用户名
+        content = content or ""   # 处理空内容
 
-    def _check_tokens(self, records, max_tokens=None):  # 添加默认值
-        """准备用于总结的聊天内容"""
+        # 将时间戳转换为可读格式
+        time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+
+        if msg_type in [str(ContextType.IMAGE), str(ContextType.VOICE)]:
+            content = f"[{msg_type}]"
+        # 不需要特别处理 EXPLAIN 类型，因为内容已经包含了描述信息
+        
+        sentence = f'[{time_str}] {username}: "{content}"'
+        if is_triggered:
+            sentence += " <T>"
+        return sentence
+
+    def _estimate_tokens(self, text):
+        """统计文本的 token 数"""
+        return self.token_counter.count(text)
+
+    def _record_tokens(self, record, sentence):
+        """一条格式化后的记录加上分隔的换行符所占的 token 数；优先使用入库时的计数，否则按记录缓存"""
+        if len(record) > 7 and record[7] is not None:
+            return record[7] + 1
+        return self.token_counter.count_record((record[1], record[0]), sentence) + 1
+
+    def _split_records_to_chunks(self, records, max_chunks):
+        """
+        将记录切分为时间上连续、且每段都不超过输入上限的若干段
+
+        :param records: 按时间倒序排列的记录
+        :param max_chunks: 最多保留的段数，超出时丢弃最早的部分
+        :return: 按时间正序排列的聊天内容列表
+        """
+        max_tokens = self.input_max_tokens_limit
+        chunks = []
         messages = []
-        total_length = 0
-        # 修改变量名
-        max_input_chars = self.input_max_tokens_limit * 4  # 粗略估计：1个 token 约等于 4 个字符
+        total_tokens = 0
 
-        # 记录已经是倒序的（最新的在前），直接处理
         for record in records:
-            username = record[2] or ""  # 处理空用户名
-            content = record[3] or ""   # 处理空内容
-            timestamp = record[5]
-            is_triggered = record[6]
+            sentence = self._format_record(record)
+            tokens = self._record_tokens(record, sentence)
+            if tokens > max_tokens:
+                # 单条记录超过输入上限时截断
+                sentence = self.token_counter.truncate(sentence, max_tokens - 1)
+                tokens = self.token_counter.count(sentence) + 1
+            if messages and total_tokens + tokens > max_tokens:
+                chunks.append("\n\n".join(messages[::-1]))
+                messages = []
+                total_tokens = 0
+                if len(chunks) >= max_chunks:
+                    logger.info(f"[Summary] 聊天记录超过 {max_chunks} 段，忽略更早的消息")
+                    break
+            messages.append(sentence)
+            total_tokens += tokens
+        else:
+            if messages:
+                chunks.append("\n\n".join(messages[::-1]))
 
-            # 将时间戳转换为可读格式
-            time_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+        return chunks[::-1]
 
-            if record[4] in [str(ContextType.IMAGE), str(ContextType.VOICE)]:
-                content = f"[{record[4]}]"
-            # 不需要特别处理 EXPLAIN 类型，因为内容已经包含了描述信息
-            
-            sentence = f'[{time_str}] {username}: "{content}"'
-            if is_triggered:
-                sentence += " <T>"
+    def _summarize_chunks(self, chunks, custom_prompt, prompt_type="summary"):
+        """并发总结多段内容，返回与 chunks 顺序一致的结果列表，失败的段为 None"""
+        outcomes = self.llm_engine.run(self._gather_chunk_summaries(chunks, custom_prompt, prompt_type))
+        results = []
+        for index, result in enumerate(outcomes):
+            if isinstance(result, Exception):
+                result = f"总结失败：{result}"
+            if not result or result.startswith("总结失败"):
+                logger.error(f"[Summary] 第 {index + 1}/{len(chunks)} 段总结失败: {result}")
+                result = None
+            results.append(result)
+        return results
 
-            # 检查添加此记录后是否会超出限制
-            if total_length + len(sentence) + 2 > self.input_max_tokens_limit * 4:  # 2 是换行符的长度
-                logger.info(f"[Summary] 输入长度限制已达到 {total_length} 个字符")
-                break
-            messages.append(sentence)
-            total_length += len(sentence) + 2
+    async def _gather_chunk_summaries(self, chunks, custom_prompt, prompt_type):
+        """在引擎中并发总结各段，单个请求内同时进行的分段数不超过 summary_map_concurrency"""
+        limit = asyncio.Semaphore(self.summary_map_concurrency)
+
+        async def summarize(chunk):
+            async with limit:
+                return await self._chat_completion_async(chunk, custom_prompt, prompt_type)
+
+        return await asyncio.gather(*(summarize(chunk) for chunk in chunks), return_exceptions=True)
 
-        # 将消息按时间顺序拼接（从早到晚）
-        query = "\n\n".join(messages[::-1])
-        return query
+    def _reduce_summarys(self, partials, custom_prompt):
+        """
+        合并多段总结；合并输入超过输入上限时，先分组合并再逐层合并
+
+        :return: (合并后的总结, 是否全部合并成功)；合并失败时退回拼接的分段总结
+        """
+        max_tokens = self.input_max_tokens_limit
+        complete = True
+        while len(partials) > 1:
+            groups = []
+            group = []
+            group_tokens = 0
+            for index, partial in enumerate(partials):
+                text = f"【第{index + 1}段总结】\n{partial}"
+                tokens = self.token_counter.count(text) + 1
+                if len(group) >= 2 and group_tokens + tokens > max_tokens:
+                    groups.append(group)
+                    group = []
+                    group_tokens = 0
+                group.append(text)
+                group_tokens += tokens
+            groups.append(group)
+
+            if len(groups) == 1:
+                merged = self._chat_completion("\n\n".join(groups[0]), custom_prompt, prompt_type="merge")
+                if merged and not merged.startswith("总结失败"):
+                    return merged, True
+                logger.error(f"[Summary] 合并分段总结失败: {merged}")
+                return "\n\n".join(partials), False
+
+            logger.info(f"[Summary] 分段总结过长，先分 {len(groups)} 组合并")
+            merged = self._summarize_chunks(["\n\n".join(g) for g in groups], custom_prompt, prompt_type="merge")
+            # 某一组合并失败时保留该组的原始分段总结
+            next_partials = []
+            for group_partials, result in zip(groups, merged):
+                if result:
+                    next_partials.append(result)
+                else:
+                    next_partials.extend(text.split("\n", 1)[1] for text in group_partials)
+            if len(next_partials) >= len(partials):
+                return "\n\n".join(partials), False
+            complete = complete and all(merged)
+            partials = next_partials
+        return partials[0], complete
+
+    def _split_messages_to_summarys(self, records, custom_prompt="", max_summarys=10, streamer=None):
+        """
+        将消息分割成块并总结每个块
+
+        聊天记录在输入上限之内时直接总结（传入 streamer 时流式输出）；超过时按时间切分为最多 max_summarys 段，
+        并发总结各段（map），再合并为一份总结（reduce）。
 
-    def _split_messages_to_summarys(self, records, custom_prompt="", max_summarys=10):
-        """将消息分割成块并总结每个块"""
+        :return: (总结列表, 是否完整)；有分段总结失败或合并失败时结果不完整，不应缓存或作为检查点
+        """
         summarys = []
-        query = self._check_tokens(records)
-        if query:
+        chunks = self._split_records_to_chunks(records, max_summarys)
+        if not chunks:
+            return summarys, False
+
+        if len(chunks) == 1:
             try:
-                result = self._chat_completion(query, custom_prompt, prompt_type="summary")
+                result = self._chat_completion(chunks[0], custom_prompt, prompt_type="summary", streamer=streamer)
                 summarys.append(result)
             except Exception as e:
                 logger.error(f"[Summary] 总结失败: {e}")
+                return summarys, False
+            return summarys, bool(result) and not result.startswith("总结失败")
+
+        start = time.time()
+        partials = self._summarize_chunks(chunks, custom_prompt)
+        succeeded = [p for p in partials if p]
+        logger.info(f"[Summary] 分段总结完成 {len(succeeded)}/{len(chunks)} 段，耗时 {time.time() - start:.1f} 秒")
+        if not succeeded:
+            return summarys, False
+
+        result, complete = self._reduce_summarys(succeeded, custom_prompt)
+        if len(succeeded) < len(chunks):
+            complete = False
+            result += f"\n\n（注：共 {len(chunks)} 段聊天记录，其中 {len(chunks) - len(succeeded)} 段总结失败）"
+        summarys.append(result)
+        return summarys, complete
+
+    def _summary_prompt_hash(self, custom_prompt):
+        """生效的总结提示词（替换 {custom_prompt} 之后）和模型的哈希，用于区分不同指令的总结"""
+        effective_prompt = self.default_summary_prompt.replace("{custom_prompt}", custom_prompt if custom_prompt else "无")
+        return hashlib.sha1(f"{self.open_ai_model}\0{effective_prompt}".encode("utf-8")).hexdigest()
+
+    def _load_checkpoint(self, session_id, prompt_hash):
+        """
+        读取会话的总结检查点
+
+        :return: (first_timestamp, last_timestamp, boundary_msgids, summary) 或 None，
+                 boundary_msgids 为 last_timestamp 这一秒内已总结的 msgid 集合
+        """
+        with self.db.read() as conn:
+            cursor = conn.cursor()
+            if self.use_postgres:
+                cursor.execute(
+                    "SELECT first_timestamp, last_timestamp, last_msgid, summary, boundary_msgids FROM summary_checkpoints WHERE sessionid=%s AND prompt_hash=%s",
+                    (session_id, prompt_hash)
+                )
+            else:
+                cursor.execute(
+                    "SELECT first_timestamp, last_timestamp, last_msgid, summary, boundary_msgids FROM summary_checkpoints WHERE sessionid=? AND prompt_hash=?",
+                    (session_id, prompt_hash)
+                )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        first_timestamp, last_timestamp, last_msgid, summary, boundary_msgids = row
+        if boundary_msgids is None:
+            # 旧版本的检查点只记录了最后一条消息
+            if last_msgid is None:
+                return None
+            boundary = {last_msgid}
+        else:
+            boundary = {int(msgid) for msgid in boundary_msgids.split(",") if msgid}
+        return first_timestamp, last_timestamp, boundary, summary
+
+    def _save_checkpoint(self, session_id, prompt_hash, first_timestamp, last_timestamp, boundary, summary):
+        """保存会话的总结检查点，boundary 为 last_timestamp 这一秒内已总结的 msgid 集合"""
+        row = (session_id, prompt_hash, first_timestamp, last_timestamp, max(boundary), summary, int(time.time()),
+               ",".join(str(msgid) for msgid in sorted(boundary)))
+        try:
+            with self.db.write() as conn:
+                cursor = conn.cursor()
+                if self.use_postgres:
+                    cursor.execute(
+                        "INSERT INTO summary_checkpoints (sessionid, prompt_hash, first_timestamp, last_timestamp, last_msgid, summary, updated_at, boundary_msgids) "
+                        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (sessionid, prompt_hash) DO UPDATE SET "
+                        "first_timestamp = EXCLUDED.first_timestamp, last_timestamp = EXCLUDED.last_timestamp, "
+                        "last_msgid = EXCLUDED.last_msgid, summary = EXCLUDED.summary, updated_at = EXCLUDED.updated_at, "
+                        "boundary_msgids = EXCLUDED.boundary_msgids",
+                        row
+                    )
+                else:
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO summary_checkpoints (sessionid, prompt_hash, first_timestamp, last_timestamp, last_msgid, summary, updated_at, boundary_msgids) "
+                        "VALUES (?,?,?,?,?,?,?,?)",
+                        row
+                    )
+        except Exception as e:
+            logger.error(f"[Summary] 保存总结检查点失败: {e}")
+
+    def _incremental_summary(self, records, custom_prompt, checkpoint):
+        """
+        基于检查点做增量总结
+
+        :param records: 按时间倒序排列的记录
+        :return: 总结文本；检查点不适用于本次请求时返回 None
+        """
+        first_timestamp, last_timestamp, boundary, prior_summary = checkpoint
+        if not prior_summary or first_timestamp is None or last_timestamp is None:
+            return None
+
+        oldest = records[-1][5]
+        newest = records[0][5]
+        if newest < last_timestamp:
+            return None  # 检查点覆盖了本次请求之后的消息
+        # 检查点中超出本次请求时间范围的部分（请求起点之前）占比过大时，不复用
+        if oldest > first_timestamp:
+            span = max(last_timestamp - first_timestamp, 1)
+            if (oldest - first_timestamp) / span > self.summary_checkpoint_tolerance:
+                return None
+
+        # 检查点没有覆盖的记录：更早的、更晚的，以及检查点最后一秒内尚未总结的消息
+        uncovered = [
+            r for r in records
+            if r[5] < first_timestamp or r[5] > last_timestamp or (r[5] == last_timestamp and r[0] not in boundary)
+        ]
+        if not uncovered:
+            logger.info("[Summary] 检查点之后没有新消息，直接返回上一次的总结")
+            return prior_summary
+
+        sentences = [self._format_record(r) for r in uncovered]
+        delta_tokens = sum(self._record_tokens(r, sentence) for r, sentence in zip(uncovered, sentences))
+        if delta_tokens > self.input_max_tokens_limit - self.token_counter.count(prior_summary):
+            return None  # 新增记录过多，走完整的分段总结
+
+        logger.info(f"[Summary] 使用增量总结，新增 {len(uncovered)} 条记录（请求共 {len(records)} 条）")
+        delta = "\n\n".join(sentences[::-1])
+        content = f"【之前的总结】\n{prior_summary}\n\n【新增聊天记录】\n{delta}"
+        result = self._chat_completion(content, custom_prompt, prompt_type="incremental")
+        if not result or result.startswith("总结失败"):
+            logger.error(f"[Summary] 增量总结失败，改为完整总结: {result}")
+            return None
+        return result
+
+    def _summary_cache_key(self, session_id, records, prompt_hash):
+        """由会话、所选记录的 msgid/时间边界和提示词哈希组成的缓存键"""
+        newest, oldest = records[0], records[-1]
+        return f"{session_id}:{oldest[0]}@{oldest[5]}-{newest[0]}@{newest[5]}:{len(records)}:{prompt_hash}"
+
+    def _get_cached_summary(self, cache_key):
+        """读取缓存的总结，先查进程内缓存，再查数据库（启用持久化时）"""
+        summary = self.summary_cache.get(cache_key)
+        if summary is not None or not self.summary_cache_persist:
+            return summary
+        try:
+            with self.db.read() as conn:
+                cursor = conn.cursor()
+                if self.use_postgres:
+                    cursor.execute("SELECT summary, created_at FROM summary_cache WHERE cache_key=%s", (cache_key,))
+                else:
+                    cursor.execute("SELECT summary, created_at FROM summary_cache WHERE cache_key=?", (cache_key,))
+                row = cursor.fetchone()
+        except Exception as e:
+            logger.error(f"[Summary] 读取总结缓存失败: {e}")
+            return None
+        if row and time.time() - row[1] <= self.summary_cache_ttl:
+            self.summary_cache.put(cache_key, row[0])
+            return row[0]
+        return None
+
+    def _put_cached_summary(self, cache_key, summary):
+        """写入总结缓存，启用持久化时同时写入数据库并清理过期条目"""
+        self.summary_cache.put(cache_key, summary)
+        if not self.summary_cache_persist:
+            return
+        now = int(time.time())
+        try:
+            with self.db.write() as conn:
+                cursor = conn.cursor()
+                if self.use_postgres:
+                    cursor.execute(
+                        "INSERT INTO summary_cache VALUES (%s, %s, %s) ON CONFLICT (cache_key) DO UPDATE SET summary = EXCLUDED.summary, created_at = EXCLUDED.created_at",
+                        (cache_key, summary, now)
+                    )
+                    cursor.execute("DELETE FROM summary_cache WHERE created_at < %s", (now - self.summary_cache_ttl,))
+                else:
+                    cursor.execute("INSERT OR REPLACE INTO summary_cache VALUES (?,?,?)", (cache_key, summary, now))
+                    cursor.execute("DELETE FROM summary_cache WHERE created_at < ?", (now - self.summary_cache_ttl,))
+        except Exception as e:
+            logger.error(f"[Summary] 写入总结缓存失败: {e}")
+
+    def _summarize_records(self, session_id, records, custom_prompt, streamer=None):
+        """
+        总结记录：命中结果缓存时直接返回；相同的请求正在进行时等待并共享其结果；
+        否则优先基于检查点做增量总结，再退回完整总结；成功后更新检查点和缓存
+
+        :param records: 按时间倒序排列的记录
+        :param streamer: 可选的 TopicStreamer，完整总结时用于按主题流式发送
+        :return: 总结列表
+        """
+        prompt_hash = self._summary_prompt_hash(custom_prompt)
+        cache_key = self._summary_cache_key(session_id, records, prompt_hash)
+        cached = self._get_cached_summary(cache_key)
+        if cached is not None:
+            logger.info(f"[Summary] 命中总结缓存: {cache_key}")
+            return [cached]
+
+        summarys, shared = self.summary_flight.do(
+            cache_key, lambda: self._compute_summary(session_id, records, custom_prompt, prompt_hash, cache_key, streamer)
+        )
+        if shared:
+            logger.info(f"[Summary] 相同的总结请求正在进行，复用其结果: {cache_key}")
+        return list(summarys)
+
+    def _compute_summary(self, session_id, records, custom_prompt, prompt_hash, cache_key, streamer=None):
+        """执行总结（增量或完整），成功后更新检查点和缓存"""
+        checkpoint = None
+        if self.summary_checkpoint_enabled:
+            try:
+                checkpoint = self._load_checkpoint(session_id, prompt_hash)
+            except Exception as e:
+                logger.error(f"[Summary] 读取总结检查点失败: {e}")
+
+        first_timestamp = records[-1][5]
+        summary = self._incremental_summary(records, custom_prompt, checkpoint) if checkpoint else None
+        if summary is not None:
+            # 增量总结覆盖了检查点原有的范围和本次请求的范围
+            first_timestamp = min(first_timestamp, checkpoint[0])
+            summarys, complete = [summary], True
+        else:
+            summarys, complete = self._split_messages_to_summarys(records, custom_prompt, self.max_summary_chunks, streamer)
+
+        # 部分分段或合并失败的结果只返回给用户，不缓存，也不作为之后增量总结的基础
+        if complete and len(summarys) == 1:
+            self._put_cached_summary(cache_key, summarys[0])
+            if self.summary_checkpoint_enabled:
+                last_timestamp = records[0][5]
+                boundary = {r[0] for r in records if r[5] == last_timestamp}
+                if checkpoint and summary is not None and checkpoint[1] == last_timestamp:
+                    # 增量总结时，这一秒内还包括检查点已经总结过的消息
+                    boundary |= checkpoint[2]
+                self._save_checkpoint(session_id, prompt_hash, first_timestamp, last_timestamp, boundary, summarys[0])
         return summarys
 
     def _parse_summary_command(self, command_parts):
@@ -995,6 +1713,9 @@ class Summary(Plugin):
         logger.debug("[Summary] on_handle_context. content: %s" % content)
         trigger_prefix = self.config.get('plugin_trigger_prefix', "$")
         clist = content.split()
+        if clist[0] == f"{trigger_prefix}搜索":
+            self._handle_search(e_context, " ".join(clist[1:]))
+            return
         if clist[0].startswith(trigger_prefix):
             
             # 解析命令
@@ -1014,8 +1735,15 @@ class Summary(Plugin):
             if is_group and content.startswith(f"{msg.actual_user_id}:"):
                 content = content[len(msg.actual_user_id) + 1:].strip()
             
+            # 先写出缓冲区中尚未入库的消息，保证总结包含最新的聊天记录
+            self.ingest_queue.flush()
+
             # 传递is_group参数给_get_records方法
-            records = self._get_records(session_id, start_time, limit, is_group=is_group)
+            # 最多能用上 max_summary_chunks 段、每段 input_max_tokens_limit 个 token，超出的部分不再读取
+            records = self._get_records(
+                session_id, start_time, limit, is_group=is_group,
+                max_tokens=self.input_max_tokens_limit * self.max_summary_chunks,
+            )
             
             if not records:
                 reply = Reply(ReplyType.ERROR, "没有找到聊天记录")
@@ -1023,7 +1751,12 @@ class Summary(Plugin):
                 e_context.action = EventAction.BREAK_PASS
                 return
             
-            summarys = self._split_messages_to_summarys(records, custom_prompt)
+            streamer = None
+            channel = e_context["channel"] if self.summary_stream else None
+            if channel is not None:
+                streamer = TopicStreamer(lambda text: channel.send(Reply(ReplyType.TEXT, text), context))
+
+            summarys = self._summarize_records(session_id, records, custom_prompt, streamer)
             if not summarys:
                 reply = Reply(ReplyType.ERROR, "总结失败")
                 e_context["reply"] = reply
@@ -1031,6 +1764,9 @@ class Summary(Plugin):
                 return
             
             result = "\n\n".join(summarys)
+            if streamer is not None and streamer.topics_sent and len(summarys) == 1 and summarys[0] == streamer.text.strip():
+                # 前面的主题已经分条发送，最终回复只包含最后一个主题
+                result = streamer.remainder() or result
             reply = Reply(ReplyType.TEXT, result)
             e_context["reply"] = reply
             e_context.action = EventAction.BREAK_PASS
@@ -1040,5 +1776,5 @@ class Summary(Plugin):
         if not verbose:
             return help_text
         trigger_prefix = self.config.get('plugin_trigger_prefix', "$")
-        help_text += f"使用方法:输入\"{trigger_prefix}总结 最近消息数量\"，我会帮助你总结聊天记录。\n例如：\"{trigger_prefix}总结 100\"，我会总结最近100条消息。\n\n你也可以直接输入\"{trigger_prefix}总结前99条信息\"或\"{trigger_prefix}总结3小时内的最近10条消息\"\n我会尽可能理解你的指令。"
+        help_text += f"使用方法:输入\"{trigger_prefix}总结 最近消息数量\"，我会帮助你总结聊天记录。\n例如：\"{trigger_prefix}总结 100\"，我会总结最近100条消息。\n\n你也可以直接输入\"{trigger_prefix}总结前99条信息\"或\"{trigger_prefix}总结3小时内的最近10条消息\"\n我会尽可能理解你的指令。\n\n输入\"{trigger_prefix}搜索 关键词\"可以搜索本会话的聊天记录。"
         return help_text
@@ -0,0 +1,200 @@
+# encoding:utf-8
+
+import re
+from functools import lru_cache
+from xml.etree.ElementTree import ParseError, XMLPullParser
+from xml.sax.saxutils import escape
+
+from common.log import logger
+
+# 消息分类，与引用消息 JSON 中的 quote_type 取值一致
+MSG_MUSIC = "music"
+MSG_VIDEO = "video"
+MSG_SHARE = "share"
+MSG_IMAGE = "image"
+MSG_QUOTE = "quote"
+MSG_TEXT = "text"
+
+# 视频号等当前客户端无法展示的卡片，标题为固定的提示文本（兼容中英文版本）
+UNSUPPORTED_TITLES = ("不支持展示该内容", "Your current Weixin version does not support this content")
+# 分类为视频卡片时使用更宽松的英文匹配，各处理函数再按 is_unsupported 细分
+_VIDEO_TITLES = ("不支持展示该内容", "not support this content")
+
+_MUSIC_TITLE_RE = re.compile(r"^\[(.*?)\](.*)$", re.S)
+_QUOTE_RE = re.compile(r"「(.*?):([\s\S]*?)」[\s\S]*?----------([\s\S]*)")
+
+# XML 解析失败（如被截断的引用内容）时使用的正则
+_TYPE_RE = re.compile(r"<type>(\d+)</type>")
+_TITLE_RE = re.compile(r"<title>(.*?)</title>")
+_DES_RE = re.compile(r"<des>(.*?)</des>")
+_URL_RE = re.compile(r"<url>(.*?)</url>")
+_FINDER_DESC_RE = re.compile(r"<finderFeed>.*?<desc>(.*?)</desc>", re.S)
+_DESC_RE = re.compile(r"<desc>(.*?)</desc>")
+_NICKNAME_RE = re.compile(r"<nickname>(.*?)</nickname>")
+_BIZ_NICKNAME_RE = re.compile(r"<bizNickname>(.*?)</bizNickname>")
+
+# appmsg 下直接读取的字段
+_APPMSG_FIELDS = ("type", "title", "des", "url")
+
+
+class ParsedMessage:
+    """一条消息的分类结果及分类所需的字段，由 classify_message 生成，不应修改"""
+
+    __slots__ = (
+        "kind", "xml_decl", "app_type", "title", "des", "url", "finder_desc", "desc", "nickname", "biz_nickname",
+        "quoted_person", "quoted_content", "reply",
+    )
+
+    def __init__(self, kind=MSG_TEXT):
+        self.kind = kind
+        self.xml_decl = False  # 内容中是否有 <?xml 声明，音乐和视频卡片只在有声明时识别
+        self.app_type = None
+        self.title = None
+        self.des = None
+        self.url = None
+        self.finder_desc = None
+        self.desc = None
+        self.nickname = None
+        self.biz_nickname = None
+        self.quoted_person = None
+        self.quoted_content = None
+        self.reply = None
+
+    @property
+    def is_quote(self):
+        """是否为引用消息；引用的内容本身是卡片时，kind 为卡片的分类"""
+        return self.quoted_person is not None
+
+    def is_unsupported(self, markers=UNSUPPORTED_TITLES):
+        """标题是否包含 markers 中的“不支持展示”提示文本"""
+        title = self.title or ""
+        return any(marker in title for marker in markers)
+
+    @property
+    def music_app(self):
+        """音乐分享的应用名称，标题形如 [QQ音乐]歌名"""
+        match = _MUSIC_TITLE_RE.match(self.title or "")
+        return match.group(1).strip() if match else ""
+
+    @property
+    def music_title(self):
+        match = _MUSIC_TITLE_RE.match(self.title or "")
+        return match.group(2).strip() if match else ""
+
+    @property
+    def video_desc(self):
+        """视频卡片的描述：依次尝试 finderFeed/desc、desc、nickname、bizNickname"""
+        if self.finder_desc:
+            return self.finder_desc
+        if self.desc:
+            return self.desc
+        if self.nickname:
+            return f"来自{self.nickname}的视频"
+        if self.biz_nickname:
+            return f"来自{self.biz_nickname}的视频"
+        return None
+
+
+def _extract_xml(text):
+    """
+    取出消息中的 XML 文档部分（从 <?xml 或 <msg 开始，到最后一个 </msg> 为止）
+
+    群聊消息前可能带有 wxid:\n 前缀，引用消息中 XML 位于「」之内，因此不要求消息以 XML 开头。
+    """
+    start = text.find("<?xml")
+    if start < 0:
+        start = text.find("<msg")
+    end = text.rfind("</msg>")
+    return text[start:end + len("</msg>")] if end > start else text[start:]
+
+
+def _parse_xml(payload, result):
+    """用 XMLPullParser 单次遍历 XML，填充 result 的字段"""
+    parser = XMLPullParser(events=("start", "end"))
+    parser.feed(payload)
+    parser.close()
+    path = []
+    for event, elem in parser.read_events():
+        if event == "start":
+            path.append(elem.tag)
+            continue
+
+        tag = path.pop()
+        # 与正则提取的结果保持一致：保留实体转义（如 URL 中的 &amp;）
+        text = escape((elem.text or "").strip())
+        if not text:
+            continue
+        if len(path) >= 1 and path[-1] == "appmsg" and tag in _APPMSG_FIELDS:
+            field = "app_type" if tag == "type" else tag
+            if getattr(result, field) is None:
+                setattr(result, field, text)
+        elif tag == "desc":
+            if result.finder_desc is None and "finderFeed" in path:
+                result.finder_desc = text
+            if result.desc is None:
+                result.desc = text
+        elif tag == "nickname" and result.nickname is None:
+            result.nickname = text
+        elif tag == "bizNickname" and result.biz_nickname is None:
+            result.biz_nickname = text
+
+
+def _parse_regex(payload, result):
+    """XML 格式错误时按字段逐个匹配"""
+    for field, pattern in (
+        ("app_type", _TYPE_RE), ("title", _TITLE_RE), ("des", _DES_RE), ("url", _URL_RE),
+        ("finder_desc", _FINDER_DESC_RE), ("desc", _DESC_RE), ("nickname", _NICKNAME_RE), ("biz_nickname", _BIZ_NICKNAME_RE),
+    ):
+        match = pattern.search(payload)
+        if match and match.group(1).strip():
+            setattr(result, field, match.group(1).strip())
+
+
+def _parse_payload(content):
+    """解析消息中的 XML 部分，返回填充了字段的 ParsedMessage"""
+    payload = _extract_xml(content)
+    result = ParsedMessage()
+    try:
+        _parse_xml(payload, result)
+    except ParseError as e:
+        logger.debug(f"[Summary] XML 解析失败，使用正则提取: {e}")
+        result = ParsedMessage()
+        _parse_regex(payload, result)
+    return result
+
+
+@lru_cache(maxsize=256)
+def classify_message(content):
+    """
+    对消息内容分类：音乐分享、视频卡片、分享卡片、图片、引用或普通文本
+
+    包含 <msg> 的内容只解析一次，得到分类所需的全部字段；XML 格式错误时退回正则匹配。
+    分类条件与逐个正则匹配时一致：卡片要求同时包含 <msg> 和 <appmsg，音乐和视频卡片还要求有 <?xml 声明；
+    引用格式单独识别，引用的内容是卡片时 kind 为卡片的分类，is_quote 为 True。
+    同一条消息会被多个处理函数分类，结果按内容缓存。
+    """
+    content = content or ""
+    if "<msg>" in content and ("<appmsg" in content or "<img" in content or "cdnthumburl" in content):
+        result = _parse_payload(content)
+        result.xml_decl = "<?xml" in content
+        title = result.title or ""
+        if "<appmsg" in content:
+            if result.xml_decl and result.app_type == "3" and _MUSIC_TITLE_RE.match(title):
+                result.kind = MSG_MUSIC
+            elif result.xml_decl and result.is_unsupported(_VIDEO_TITLES):
+                result.kind = MSG_VIDEO
+            else:
+                result.kind = MSG_SHARE
+        else:
+            result.kind = MSG_IMAGE
+    else:
+        result = ParsedMessage(MSG_TEXT)
+
+    match = _QUOTE_RE.search(content)
+    if match:
+        if result.kind == MSG_TEXT:
+            result.kind = MSG_QUOTE
+        result.quoted_person = match.group(1).strip()
+        result.quoted_content = match.group(2).strip()
+        result.reply = match.group(3).strip()
+    return result
@@ -0,0 +1,248 @@
+# encoding:utf-8
+
+import asyncio
+import threading
+import time
+from itertools import count
+
+from common.log import logger
+
+# 优先级：数值越小越优先
+PRIORITY_INTERACTIVE = 0  # 用户主动发起的 $总结
+PRIORITY_LINK = 1  # 链接总结
+PRIORITY_BACKGROUND = 2  # 后台识图
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_LINK: "link",
+    PRIORITY_BACKGROUND: "background",
+}
+
+# 等待配额时的最长单次休眠（秒），期间队列中更高优先级的请求可能已经离开
+_MAX_POLL_INTERVAL = 0.5
+
+
+class RateLimitExceeded(Exception):
+    """配额不足，低优先级请求在允许的等待时间内无法获得配额而被丢弃"""
+
+
+class TokenBucket:
+    """每分钟 per_minute 个令牌的令牌桶，容量为一分钟的配额"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, reserve=0.0):
+        """取走 amount 个令牌且桶中仍保留 reserve 比例的容量，需要等待的秒数"""
+        need = min(self.capacity, min(amount, self.capacity) + reserve * self.capacity)
+        if self.tokens >= need:
+            return 0.0
+        return (need - self.tokens) / self.rate
+
+    def take(self, amount):
+        self.tokens -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class _Ticket:
+    __slots__ = ("key", "priority", "seq", "tokens", "enqueued")
+
+    def __init__(self, key, priority, seq, tokens):
+        self.key = key
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+
+
+class _KeyState:
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.waiting = []
+        self.granted = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.dropped = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.wait_ms = dict.fromkeys(PRIORITY_NAMES, 0.0)
+
+
+class LLMScheduler:
+    """
+    LLM 请求的配额调度器
+
+    每个 API Key 有两个令牌桶：每分钟请求数（rpm）和每分钟 token 数（tpm），为 0 表示不限制。
+    同一个 Key 的等待请求按优先级、再按到达顺序获得配额；低优先级请求只能使用桶中
+    reserve 比例以上的配额，把余量留给高优先级请求，等待超过 max_wait 秒时被丢弃（抛出 RateLimitExceeded）。
+    同步调用使用 acquire，事件循环中使用 acquire_async。
+    """
+
+    def __init__(self, rpm=0, tpm=0, max_wait=None, reserve=None):
+        self._cond = threading.Condition()
+        self._keys = {}
+        self._seq = count()
+        self.configure(rpm, tpm, max_wait, reserve)
+
+    def configure(self, rpm=0, tpm=0, max_wait=None, reserve=None):
+        """
+        :param max_wait: {优先级: 最长等待秒数}，None 表示一直等待
+        :param reserve: {优先级: 为更高优先级保留的配额比例}
+        """
+        with self._cond:
+            self.rpm = rpm or 0
+            self.tpm = tpm or 0
+            self.max_wait = {PRIORITY_INTERACTIVE: None, PRIORITY_LINK: 60, PRIORITY_BACKGROUND: 30}
+            self.max_wait.update(max_wait or {})
+            self.reserve = {PRIORITY_INTERACTIVE: 0.0, PRIORITY_LINK: 0.1, PRIORITY_BACKGROUND: 0.3}
+            self.reserve.update(reserve or {})
+            # 配额变化后重新建桶，统计一并清零
+            self._keys = {key: _KeyState(self.rpm, self.tpm) for key in self._keys}
+            self._cond.notify_all()
+
+    @property
+    def enabled(self):
+        return bool(self.rpm or self.tpm)
+
+    def _state(self, key):
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = _KeyState(self.rpm, self.tpm)
+        return state
+
+    def _enqueue(self, key, tokens, priority):
+        with self._cond:
+            ticket = _Ticket(key, priority, next(self._seq), tokens)
+            self._state(key).waiting.append(ticket)
+            return ticket
+
+    def _dequeue(self, ticket):
+        with self._cond:
+            state = self._keys.get(ticket.key)
+            if state is not None and ticket in state.waiting:
+                state.waiting.remove(ticket)
+            self._cond.notify_all()
+
+    def _try_grant(self, ticket):
+        """尝试为 ticket 分配配额，成功返回 0，否则返回建议等待的秒数；需持有锁"""
+        state = self._state(ticket.key)
+        if ticket not in state.waiting:
+            # configure 重建了状态，重新排队
+            state.waiting.append(ticket)
+        now = time.monotonic()
+        reserve = self.reserve.get(ticket.priority, 0.0)
+        wait = 0.0
+        for bucket, amount in ((state.requests, 1), (state.tokens, ticket.tokens)):
+            if bucket is not None:
+                bucket.refill(now)
+                wait = max(wait, bucket.wait_time(amount, reserve))
+
+        head = min(state.waiting, key=lambda t: (t.priority, t.seq))
+        if head is not ticket:
+            wait = max(wait, 0.05)
+
+        waited = now - ticket.enqueued
+        max_wait = self.max_wait.get(ticket.priority)
+        if wait > 0 and max_wait is not None and waited + wait > max_wait:
+            state.dropped[ticket.priority] += 1
+            raise RateLimitExceeded(
+                f"LLM 配额不足，{PRIORITY_NAMES.get(ticket.priority, ticket.priority)} 请求需等待 {wait:.1f} 秒，超过上限 {max_wait} 秒"
+            )
+        if wait > 0:
+            return wait
+
+        for bucket, amount in ((state.requests, 1), (state.tokens, ticket.tokens)):
+            if bucket is not None:
+                bucket.take(amount)
+        state.granted[ticket.priority] += 1
+        state.wait_ms[ticket.priority] += waited * 1000
+        return 0.0
+
+    def acquire(self, key, tokens=0, priority=PRIORITY_INTERACTIVE):
+        """阻塞直到获得一次请求和 tokens 个 token 的配额"""
+        if not self.enabled:
+            return
+        ticket = self._enqueue(key, tokens, priority)
+        try:
+            with self._cond:
+                while True:
+                    wait = self._try_grant(ticket)
+                    if not wait:
+                        return
+                    self._cond.wait(min(wait, _MAX_POLL_INTERVAL))
+        finally:
+            self._dequeue(ticket)
+
+    async def acquire_async(self, key, tokens=0, priority=PRIORITY_INTERACTIVE):
+        """acquire 的协程版本，等待期间不占用线程"""
+        if not self.enabled:
+            return
+        ticket = self._enqueue(key, tokens, priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_grant(ticket)
+                if not wait:
+                    return
+                await asyncio.sleep(min(wait, _MAX_POLL_INTERVAL))
+        finally:
+            self._dequeue(ticket)
+
+    def refund(self, key, tokens):
+        """实际消耗少于预估时退回多扣的 token"""
+        if tokens <= 0:
+            return
+        with self._cond:
+            state = self._keys.get(key)
+            if state is not None and state.tokens is not None:
+                state.tokens.give_back(tokens)
+                self._cond.notify_all()
+
+    @staticmethod
+    def _mask(key):
+        key = key or ""
+        return f"{key[:3]}...{key[-4:]}" if len(key) > 8 else "***"
+
+    def stats(self):
+        """各 API Key 的剩余配额和各优先级的排队、放行、丢弃情况"""
+        now = time.monotonic()
+        with self._cond:
+            result = {}
+            for key, state in self._keys.items():
+                item = {}
+                for name, bucket in (("rpm_available", state.requests), ("tpm_available", state.tokens)):
+                    if bucket is not None:
+                        bucket.refill(now)
+                        item[name] = int(bucket.tokens)
+                waiting = dict.fromkeys(PRIORITY_NAMES, 0)
+                for ticket in state.waiting:
+                    waiting[ticket.priority] = waiting.get(ticket.priority, 0) + 1
+                for priority, name in PRIORITY_NAMES.items():
+                    granted = state.granted[priority]
+                    item[name] = {
+                        "waiting": waiting[priority],
+                        "granted": granted,
+                        "dropped": state.dropped[priority],
+                        "avg_wait_ms": round(state.wait_ms[priority] / granted, 1) if granted else 0.0,
+                    }
+                result[self._mask(key)] = item
+            return result
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def get_shared_scheduler():
+    """进程内共享的调度器，总结、链接总结和识图共用同一份配额"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = LLMScheduler()
+            logger.debug("[Summary] 已创建共享的 LLM 调度器")
+        return _shared
@@ -0,0 +1,184 @@
+# encoding:utf-8
+
+import threading
+
+from common.log import logger
+
+from .cache import LRUCache
+
+SESSION_META_DDL = '''CREATE TABLE IF NOT EXISTS session_meta
+                    (sessionid TEXT PRIMARY KEY,
+                    sessionname TEXT,
+                    is_group INTEGER,
+                    first_timestamp BIGINT,
+                    last_timestamp BIGINT,
+                    message_count BIGINT)'''
+
+
+def rebuild_session_meta(cursor):
+    """
+    清空 session_meta 并按 chat_records 重新统计，SQLite 和 PostgreSQL 通用；调用方负责提交事务
+
+    :return: 写入的会话数
+    """
+    cursor.execute("DELETE FROM session_meta")
+    # 与旧逻辑一致：sessionname 非空即视为群聊
+    cursor.execute('''INSERT INTO session_meta
+                    SELECT sessionid, MAX(sessionname),
+                           CASE WHEN MAX(sessionname) IS NOT NULL AND MAX(sessionname) <> '' THEN 1 ELSE 0 END,
+                           MIN(timestamp), MAX(timestamp), COUNT(*)
+                    FROM chat_records GROUP BY sessionid''')
+    return max(cursor.rowcount or 0, 0)
+
+
+class SessionMeta:
+    """会话元数据：是否群聊、群名称、首末消息时间和消息数量"""
+
+    __slots__ = ("sessionid", "sessionname", "is_group", "first_timestamp", "last_timestamp", "message_count")
+
+    def __init__(self, sessionid, sessionname=None, is_group=False, first_timestamp=None, last_timestamp=None, message_count=0):
+        self.sessionid = sessionid
+        self.sessionname = sessionname
+        self.is_group = bool(is_group)
+        self.first_timestamp = first_timestamp
+        self.last_timestamp = last_timestamp
+        self.message_count = message_count or 0
+
+    def apply(self, sessionname, is_group, first_timestamp, last_timestamp, count):
+        """合并一段增量"""
+        if sessionname:
+            self.sessionname = sessionname
+        self.is_group = self.is_group or bool(is_group)
+        if first_timestamp is not None:
+            self.first_timestamp = first_timestamp if self.first_timestamp is None else min(self.first_timestamp, first_timestamp)
+        if last_timestamp is not None:
+            self.last_timestamp = last_timestamp if self.last_timestamp is None else max(self.last_timestamp, last_timestamp)
+        self.message_count += count
+
+
+class SessionMetaCache:
+    """
+    session_meta 表及其进程内 LRU 缓存
+
+    on_receive_message 通过 record_message 增量更新缓存并记录待写入的增量，
+    增量由入库写线程在同一个事务中通过 write_deltas 写入 session_meta 表。
+    总结请求只读缓存或 session_meta，不再扫描 chat_records。
+    """
+
+    def __init__(self, db, use_postgres, max_size=4096):
+        self.db = db
+        self.use_postgres = use_postgres
+        self._cache = LRUCache(max_size)
+        self._dirty = {}  # sessionid -> SessionMeta 形式的增量（message_count 为新增条数）
+        self._lock = threading.Lock()
+
+    def init_schema(self, cursor):
+        """创建 session_meta 表；表为空时从 chat_records 回填一次"""
+        cursor.execute(SESSION_META_DDL)
+        cursor.execute("SELECT 1 FROM session_meta LIMIT 1")
+        if cursor.fetchone():
+            return
+        count = rebuild_session_meta(cursor)
+        if count:
+            logger.info(f"[Summary] 已从 chat_records 回填 {count} 个会话的元数据")
+
+    def _load(self, session_id, cursor=None):
+        if cursor is None:
+            with self.db.read() as conn:
+                return self._load(session_id, conn.cursor())
+        if self.use_postgres:
+            cursor.execute(
+                "SELECT sessionid, sessionname, is_group, first_timestamp, last_timestamp, message_count FROM session_meta WHERE sessionid=%s",
+                (session_id,)
+            )
+        else:
+            cursor.execute(
+                "SELECT sessionid, sessionname, is_group, first_timestamp, last_timestamp, message_count FROM session_meta WHERE sessionid=?",
+                (session_id,)
+            )
+        row = cursor.fetchone()
+        return SessionMeta(*row) if row else None
+
+    def get(self, session_id, cursor=None):
+        """
+        获取会话元数据，不存在时返回 None
+
+        :param cursor: 可选，调用方已持有连接的游标；缓存未命中时用它查询，不再另取连接
+        """
+        meta = self._cache.get(session_id)
+        if meta is not None:
+            return meta
+        meta = self._load(session_id, cursor)
+        with self._lock:
+            # 缓存被淘汰后重新加载时，合并尚未写入数据库的增量
+            delta = self._dirty.get(session_id)
+            if delta is not None:
+                if meta is None:
+                    meta = SessionMeta(session_id)
+                meta.apply(delta.sessionname, delta.is_group, delta.first_timestamp, delta.last_timestamp, delta.message_count)
+        if meta is not None:
+            self._cache.put(session_id, meta)
+        return meta
+
+    def record_message(self, session_id, session_name, is_group, timestamp):
+        """收到一条新消息时更新会话元数据"""
+        meta = self.get(session_id) or SessionMeta(session_id)
+        with self._lock:
+            meta.apply(session_name, is_group, timestamp, timestamp, 1)
+            delta = self._dirty.get(session_id)
+            if delta is None:
+                delta = self._dirty[session_id] = SessionMeta(session_id)
+            delta.apply(session_name, is_group, timestamp, timestamp, 1)
+        self._cache.put(session_id, meta)
+
+    def take_dirty(self):
+        """取出所有待写入的增量"""
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        return dirty
+
+    def restore_dirty(self, dirty):
+        """写入失败时把增量放回，下次写入时重试"""
+        with self._lock:
+            for session_id, delta in dirty.items():
+                current = self._dirty.get(session_id)
+                if current is None:
+                    self._dirty[session_id] = delta
+                else:
+                    current.apply(delta.sessionname, delta.is_group, delta.first_timestamp, delta.last_timestamp, delta.message_count)
+
+    def write_deltas(self, cursor, dirty):
+        """在调用方的事务中把增量合并进 session_meta"""
+        if not dirty:
+            return
+        rows = [
+            (d.sessionid, d.sessionname, int(d.is_group), d.first_timestamp, d.last_timestamp, d.message_count)
+            for d in dirty.values()
+        ]
+        if self.use_postgres:
+            cursor.executemany(
+                "INSERT INTO session_meta AS m VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT (sessionid) DO UPDATE SET "
+                "sessionname = COALESCE(EXCLUDED.sessionname, m.sessionname), "
+                "is_group = GREATEST(m.is_group, EXCLUDED.is_group), "
+                "first_timestamp = LEAST(m.first_timestamp, EXCLUDED.first_timestamp), "
+                "last_timestamp = GREATEST(m.last_timestamp, EXCLUDED.last_timestamp), "
+                "message_count = m.message_count + EXCLUDED.message_count",
+                rows
+            )
+        else:
+            cursor.executemany(
+                "INSERT INTO session_meta VALUES (?,?,?,?,?,?) ON CONFLICT (sessionid) DO UPDATE SET "
+                "sessionname = COALESCE(excluded.sessionname, sessionname), "
+                "is_group = MAX(is_group, excluded.is_group), "
+                "first_timestamp = MIN(COALESCE(first_timestamp, excluded.first_timestamp), excluded.first_timestamp), "
+                "last_timestamp = MAX(COALESCE(last_timestamp, excluded.last_timestamp), excluded.last_timestamp), "
+                "message_count = message_count + excluded.message_count",
+                rows
+            )
+
+    def stats(self):
+        with self._lock:
+            pending = len(self._dirty)
+        stats = self._cache.stats()
+        stats["pending_deltas"] = pending
+        return stats
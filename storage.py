@@ -0,0 +1,348 @@
+# encoding:utf-8
+
+import io
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import psycopg2
+
+from common.log import logger
+
+# chat_records 表的字段顺序，与各处 INSERT 的元组顺序一致
+CHAT_RECORD_COLUMNS = (
+    "msgid", "sessionid", "sessionname", "userid", "username", "content", "type", "timestamp", "is_triggered",
+    "token_count",
+)
+
+POSTGRES_CHAT_RECORDS_DDL = '''
+    CREATE TABLE IF NOT EXISTS chat_records (
+        msgid BIGINT NOT NULL,
+        sessionid TEXT NOT NULL,
+        sessionname TEXT,
+        userid TEXT,
+        username TEXT,
+        content TEXT,
+        type TEXT,
+        timestamp INTEGER,
+        is_triggered INTEGER,
+        token_count INTEGER,
+        PRIMARY KEY (sessionid, msgid)
+    )
+'''
+
+_COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def _copy_text_value(value):
+    """将单个字段转换为 COPY text 格式"""
+    if value is None:
+        return "\\N"
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def copy_upsert_chat_records(cursor, rows):
+    """
+    PostgreSQL 批量写入：先 COPY 到会话级临时表（不写 WAL），再用一条 INSERT ... ON CONFLICT 合并到 chat_records
+
+    临时表在提交时自动清空，每个连接各自一张，连接池中的多个写入方互不干扰。
+    调用方负责提交事务，且 rows 中不能有重复的 (sessionid, msgid)。
+
+    :param rows: 记录元组列表，字段顺序见 CHAT_RECORD_COLUMNS
+    """
+    columns = ", ".join(CHAT_RECORD_COLUMNS)
+    updates = ", ".join(f"{column} = EXCLUDED.{column}" for column in CHAT_RECORD_COLUMNS if column not in ("sessionid", "msgid"))
+
+    cursor.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS chat_records_staging "
+        "(LIKE chat_records INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+    )
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join(_copy_text_value(value) for value in row))
+        buffer.write("\n")
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY chat_records_staging ({columns}) FROM STDIN", buffer)
+    cursor.execute(
+        f"INSERT INTO chat_records ({columns}) SELECT {columns} FROM chat_records_staging "
+        f"ON CONFLICT (sessionid, msgid) DO UPDATE SET {updates}"
+    )
+    # 同一事务内可能多次调用，合并后立即清空临时表
+    cursor.execute("TRUNCATE chat_records_staging")
+
+
+class SQLiteStore:
+    """
+    SQLite 存储后端
+
+    - 启用 WAL 日志模式，读操作不会被写事务阻塞
+    - 每个读线程使用自己的只读连接（线程本地）
+    - 所有写操作通过唯一的写连接串行执行
+    """
+
+    def __init__(self, db_path, synchronous="NORMAL", cache_size_mb=64, mmap_size_mb=256, busy_timeout_ms=5000):
+        self.db_path = db_path
+        self.synchronous = synchronous
+        self.cache_size_mb = cache_size_mb
+        self.mmap_size_mb = mmap_size_mb
+        self.busy_timeout_ms = busy_timeout_ms
+
+        self._write_lock = threading.RLock()
+        self._local = threading.local()
+        self._readers = []
+        self._readers_lock = threading.Lock()
+
+        # 写连接只在持有 _write_lock 时使用，允许跨线程访问
+        self._writer = self._open_connection(check_same_thread=False)
+        journal_mode = self._writer.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if str(journal_mode).lower() != "wal":
+            logger.warning(f"[Summary] SQLite 未能启用 WAL 模式，当前模式: {journal_mode}")
+
+    def _open_connection(self, check_same_thread=True):
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000, check_same_thread=check_same_thread)
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_mb * 1024)}")  # 负数表示以 KiB 为单位
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size_mb * 1024 * 1024)}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        # INSERT OR REPLACE 替换旧行时触发删除触发器，保持全文索引同步
+        conn.execute("PRAGMA recursive_triggers=ON")
+        return conn
+
+    @contextmanager
+    def read(self):
+        """获取当前线程的只读连接"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open_connection()
+            conn.execute("PRAGMA query_only=1")
+            self._local.conn = conn
+            with self._readers_lock:
+                self._readers.append(conn)
+        try:
+            yield conn
+        finally:
+            # 结束隐式读事务，避免长期持有 WAL 快照阻碍检查点
+            if conn.in_transaction:
+                conn.rollback()
+
+    @contextmanager
+    def write(self):
+        """获取写连接，退出时提交事务，发生异常时回滚"""
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+
+    def stats(self):
+        """返回连接使用情况"""
+        with self._readers_lock:
+            return {
+                "backend": "sqlite",
+                "reader_connections": len(self._readers),
+            }
+
+    def close(self):
+        """关闭所有连接"""
+        with self._readers_lock:
+            for conn in self._readers:
+                try:
+                    conn.close()
+                except Exception:
+                    pass  # 读连接可能属于其他线程，关闭失败可以忽略
+            self._readers = []
+        with self._write_lock:
+            self._writer.close()
+
+
+class PostgresStore:
+    """
+    PostgreSQL 存储后端，使用线程安全的连接池
+
+    - 连接数在 [min_size, max_size] 之间，池满时等待其他线程归还
+    - 取出连接时先执行 SELECT 1 检查存活，失效连接（例如服务器重启后）会被丢弃并自动重连，
+      调用方的第一条语句不会因为连接失效而失败；使用中出现连接错误的连接不再放回连接池
+    - 每个连接设置 statement_timeout，避免慢查询长期占用连接
+    """
+
+    def __init__(self, dsn, min_size=1, max_size=10, statement_timeout_ms=30000, connect_timeout=10,
+                 acquire_timeout=30, health_check_interval=0):
+        """
+        :param health_check_interval: 连接空闲超过该秒数后，取出时才检查存活；默认 0，每次取出都检查。
+                                      设为正数可以省去频繁使用的连接的检查，但服务器重启后这些连接上的第一条语句会失败
+        """
+        self.dsn = dsn
+        self.min_size = max(0, int(min_size))
+        self.max_size = max(1, int(max_size), self.min_size)
+        self.statement_timeout_ms = int(statement_timeout_ms)
+        self.connect_timeout = connect_timeout
+        self.acquire_timeout = acquire_timeout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (conn, 归还时间)
+        self._size = 0
+        self._in_use = 0
+        self._closed = False
+
+        # 指标
+        self._acquired = 0
+        self._reconnects = 0
+        self._wait_total_ms = 0.0
+        self._wait_max_ms = 0.0
+        self._wait_last_ms = 0.0
+
+        for _ in range(self.min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        return psycopg2.connect(
+            self.dsn,
+            connect_timeout=self.connect_timeout,
+            options=f"-c statement_timeout={self.statement_timeout_ms}",
+            application_name="summary-plugin",
+        )
+
+    def _is_alive(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _acquire(self):
+        start = time.perf_counter()
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("[Summary] PostgreSQL 连接池已关闭")
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    conn, idle_since = None, None
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"[Summary] 等待 PostgreSQL 连接超时（{self.acquire_timeout} 秒），连接池已满: {self.max_size}")
+                self._cond.wait(remaining)
+            self._in_use += 1
+
+        try:
+            if conn is not None and not self._is_alive(conn, idle_since):
+                logger.warning("[Summary] PostgreSQL 连接已失效，正在重连")
+                self._close_quietly(conn)
+                conn = None
+                with self._cond:
+                    self._reconnects += 1
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        waited_ms = (time.perf_counter() - start) * 1000
+        with self._cond:
+            self._acquired += 1
+            self._wait_last_ms = waited_ms
+            self._wait_total_ms += waited_ms
+            self._wait_max_ms = max(self._wait_max_ms, waited_ms)
+        return conn
+
+    def _release(self, conn):
+        with self._cond:
+            self._in_use -= 1
+            if conn.closed or self._closed:
+                # 连接在使用过程中断开，丢弃后由下一次取出时重新建立
+                self._size -= 1
+                self._close_quietly(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    @contextmanager
+    def read(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # 连接可能已断开，丢弃而不是放回连接池
+            self._close_quietly(conn)
+            raise
+        finally:
+            try:
+                if not conn.closed:
+                    conn.rollback()  # 结束只读事务
+            except Exception:
+                self._close_quietly(conn)
+            self._release(conn)
+
+    @contextmanager
+    def write(self):
+        conn = self._acquire()
+        try:
+            yield conn
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # 连接可能已断开，丢弃而不是放回连接池
+            self._close_quietly(conn)
+            raise
+        except Exception:
+            try:
+                if not conn.closed:
+                    conn.rollback()
+            except Exception:
+                self._close_quietly(conn)
+            raise
+        finally:
+            self._release(conn)
+
+    def stats(self):
+        """返回连接池的使用情况和等待时间"""
+        with self._cond:
+            return {
+                "backend": "postgres",
+                "pool_min": self.min_size,
+                "pool_max": self.max_size,
+                "connections": self._size,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "acquired": self._acquired,
+                "reconnects": self._reconnects,
+                "wait_last_ms": round(self._wait_last_ms, 2),
+                "wait_max_ms": round(self._wait_max_ms, 2),
+                "wait_avg_ms": round(self._wait_total_ms / self._acquired, 2) if self._acquired else 0.0,
+            }
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._close_quietly(conn)
+                self._size -= 1
+            self._cond.notify_all()
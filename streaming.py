@@ -0,0 +1,71 @@
+# encoding:utf-8
+
+import json
+import re
+import time
+
+from common.log import logger
+
+# 总结格式中的主题标题：行首的数字键帽表情，如 1️⃣[Topic]、🔟[Topic]
+TOPIC_HEADER_RE = re.compile(r"^[ \t]*(?:\d️?⃣|\U0001f51f)", re.M)
+
+
+def parse_sse_delta(line):
+    """解析一行 SSE 输出，返回其中的增量文本；不是内容行时返回 None"""
+    if not line.startswith("data:"):
+        return None
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return None
+    try:
+        choices = json.loads(data).get("choices") or []
+    except (ValueError, AttributeError):
+        logger.debug(f"[Summary] 跳过无法解析的 SSE 行: {data[:200]}")
+        return None
+    if not choices:
+        return None
+    return (choices[0].get("delta") or {}).get("content")
+
+
+class TopicStreamer:
+    """
+    流式总结的主题切分器
+
+    LLM 的输出逐段通过 feed 追加，每出现一个新的主题标题，就说明上一个主题已经输出完整，
+    将其作为一条单独的消息发送；第一个主题之前的内容随第一个主题一起发送。
+    最后一个主题在输出结束后由调用方通过 remainder 取出，作为最终回复。
+    """
+
+    def __init__(self, send):
+        """
+        :param send: 发送一个主题块的函数，参数为文本，可能阻塞
+        """
+        self.send = send
+        self.text = ""
+        self.sent = 0  # 已发送部分在 text 中的结束位置
+        self.topics_sent = 0
+        self.started_at = time.time()
+
+    def feed(self, delta):
+        """追加一段输出，返回新输出完整的主题块"""
+        self.text += delta
+        headers = [m.start() for m in TOPIC_HEADER_RE.finditer(self.text, self.sent)]
+        blocks = []
+        # 未发送部分中第一个标题之后的每个标题，都意味着前一个主题已经结束
+        for end in headers[1:]:
+            block = self.text[self.sent:end].strip()
+            self.sent = end
+            if block:
+                blocks.append(block)
+        return blocks
+
+    def emit(self, block):
+        """发送一个主题块"""
+        self.send(block)
+        self.topics_sent += 1
+        if self.topics_sent == 1:
+            logger.info(f"[Summary] 流式总结首个主题已发送，耗时 {time.time() - self.started_at:.1f} 秒")
+
+    def remainder(self):
+        """尚未发送的内容（最后一个主题）"""
+        return self.text[self.sent:].strip()
@@ -0,0 +1,124 @@
+# encoding:utf-8
+
+import math
+import os
+import re
+
+from common.log import logger
+
+from .cache import LRUCache
+
+# 估算系数（以 cl100k_base 为基准校准）：常用汉字/假名/谚文约 1 个 token，
+# 英文等 ASCII 文本约 4 个字符 1 个 token，emoji 等其他非 ASCII 字符约 2 个 token
+CJK_TOKENS_PER_CHAR = 1.0
+ASCII_CHARS_PER_TOKEN = 4.0
+OTHER_TOKENS_PER_CHAR = 2.0
+
+# 可从本地词表文件构建的 BPE 编码：分词正则、特殊 token、词表文件的下载地址和 sha256
+_ENCODINGS = {
+    "cl100k_base": {
+        "pat_str": r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+""",
+        "special_tokens": {
+            "<|endoftext|>": 100257,
+            "<|fim_prefix|>": 100258,
+            "<|fim_middle|>": 100259,
+            "<|fim_suffix|>": 100260,
+            "<|endofprompt|>": 100276,
+        },
+        "url": "https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken",
+        "sha256": "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7",
+    },
+}
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+_NON_ASCII_RE = re.compile(r"[^\x00-\x7f]")
+
+
+def estimate_tokens(text):
+    """按字符类别估算 token 数，用于没有 BPE 词表时"""
+    if not text:
+        return 0
+    if text.isascii():
+        return math.ceil(len(text) / ASCII_CHARS_PER_TOKEN)
+    non_ascii = len(_NON_ASCII_RE.findall(text))
+    cjk = len(_CJK_RE.findall(text))
+    ascii_chars = len(text) - non_ascii
+    return math.ceil(
+        cjk * CJK_TOKENS_PER_CHAR
+        + (non_ascii - cjk) * OTHER_TOKENS_PER_CHAR
+        + ascii_chars / ASCII_CHARS_PER_TOKEN
+    )
+
+
+class TokenCounter:
+    """
+    token 计数器
+
+    优先使用 tiktoken 的 BPE 编码精确计数，词表只从本地文件 vocab_path 加载，不会联网下载；
+    词表文件不存在、未安装 tiktoken 或加载失败时退回 estimate_tokens 估算。
+    单条聊天记录的计数按记录缓存。
+    """
+
+    def __init__(self, encoding_name="cl100k_base", vocab_path=None, cache_size=65536):
+        self.encoding_name = encoding_name
+        self.backend = "estimate"
+        self._encoding = None
+        self._cache = LRUCache(cache_size)
+
+        spec = _ENCODINGS.get(encoding_name)
+        if spec is None:
+            logger.warning(f"[Summary] 不支持的编码 {encoding_name}，token 数按字符类别估算")
+        elif not vocab_path or not os.path.isfile(vocab_path):
+            logger.warning(
+                f"[Summary] 未找到 {encoding_name} 词表文件 {vocab_path}，token 数按字符类别估算；"
+                f"如需精确计数，请从 {spec['url']} 下载词表放到该路径或配置 token_vocab_path"
+            )
+        else:
+            try:
+                import tiktoken
+                from tiktoken.load import load_tiktoken_bpe
+                self._encoding = tiktoken.Encoding(
+                    name=encoding_name,
+                    pat_str=spec["pat_str"],
+                    mergeable_ranks=load_tiktoken_bpe(vocab_path, expected_hash=spec["sha256"]),
+                    special_tokens=spec["special_tokens"],
+                )
+                self.backend = f"tiktoken:{encoding_name}"
+            except ImportError:
+                logger.info("[Summary] 未安装 tiktoken，token 数按字符类别估算")
+            except Exception as e:
+                logger.warning(f"[Summary] 加载 {encoding_name} 词表失败，token 数按字符类别估算: {e}")
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self._encoding is None:
+            return estimate_tokens(text)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def count_record(self, key, line):
+        """统计一条格式化后的聊天记录的 token 数，key 标识记录（如 (sessionid, msgid)）"""
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == line:
+            return cached[1]
+        tokens = self.count(line)
+        self._cache.put(key, (line, tokens))
+        return tokens
+
+    def truncate(self, text, max_tokens):
+        """截断文本，使其不超过 max_tokens 个 token"""
+        if max_tokens <= 0:
+            return ""
+        if self._encoding is not None:
+            tokens = self._encoding.encode(text, disallowed_special=())
+            return text if len(tokens) <= max_tokens else self._encoding.decode(tokens[:max_tokens])
+        tokens = estimate_tokens(text)
+        while tokens > max_tokens:
+            text = text[:max(int(len(text) * max_tokens / tokens) - 1, 0)]
+            tokens = estimate_tokens(text)
+        return text
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats["backend"] = self.backend
+        return stats